@@ -2,12 +2,18 @@
 """
 Convert table-3.csv to QBO format using lambda_function.py logic
 """
+import argparse
 import csv
-import hashlib
-import uuid
+import os
+import sys
 from datetime import datetime
 from typing import List, Dict, Any, Optional
 
+# Share the OFX serializer with the Lambda (repo root, not the older copy next to this script)
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+sys.path.insert(0, REPO_ROOT)
+from lambda_function import _BankStatement, _StatementPeriod, _iter_ofx, _parse_date as _parse_statement_date
+
 # Configuration (matching bank_statement_01_2024.qbo)
 BANK_ID = "072000326"
 ACCT_ID = "891536836"
@@ -15,33 +21,27 @@ ACCT_TYPE = "CHECKING"
 FI_ORG = "B1"
 FI_FID = "10898"
 INTU_BID = "2430"
-
-def _parse_date(s: str) -> Optional[datetime]:
-    """Parse date from various formats, handling month/day format like '1/2'"""
-    s = (s or "").strip().strip("'")
-    if not s:
-        return None
-
-    # Handle month/day format (assume 2024)
-    if "/" in s and len(s.split("/")) == 2:
-        try:
-            month, day = s.split("/")
-            return datetime(2024, int(month), int(day))
-        except ValueError:
-            pass
-
-    # Try standard formats
-    formats = [
-        "%Y-%m-%d", "%m/%d/%Y", "%m/%d/%y", "%d-%b-%Y", "%d-%b-%y", "%Y/%m/%d",
-        "%d/%m/%Y", "%d/%m/%y"
-    ]
-    for fmt in formats:
-        try:
-            return datetime.strptime(s, fmt)
-        except ValueError:
-            pass
-
-    return None
+# Year for month/day dates when the statement period end is not known (no rollover)
+STATEMENT_YEAR = 2024
+
+def _statement_end(csv_path: str, statement_date: str = None) -> datetime:
+    """
+    Period end from --statement-date, else the Textract export's rawText.txt
+    beside the CSV. When neither is known, 31 Dec of STATEMENT_YEAR: every
+    month/day date keeps that year instead of rolling back a year.
+    """
+    period = _StatementPeriod(_parse_statement_date(statement_date or ""))
+    raw_text = os.path.join(os.path.dirname(csv_path), "rawText.txt")
+    if period.end is None and os.path.exists(raw_text):
+        with open(raw_text, 'r', encoding='utf-8-sig') as f:
+            period.read_lines(f)
+    if period.end is None:
+        print(f"Statement period end unknown, using {STATEMENT_YEAR} for month/day dates")
+    return period.end or datetime(STATEMENT_YEAR, 12, 31)
+
+def _parse_date(s: str, end: datetime) -> Optional[datetime]:
+    """Parse date from various formats; month/day dates like '1/2' take their year from `end`"""
+    return _parse_statement_date((s or "").strip().strip("'"), end)
 
 def _parse_amount(s: str) -> Optional[float]:
     """Parse amount, handling commas and Spanish/English formats"""
@@ -66,103 +66,16 @@ def _parse_amount(s: str) -> Optional[float]:
     except ValueError:
         return None
 
-def _make_fitid(d: datetime, desc: str, amt: float) -> str:
-    """Generate unique transaction ID"""
-    h = hashlib.md5(f"{d:%Y%m%d}{amt:.2f}{desc}".encode("utf-8")).hexdigest()
-    return h[:12]
-
-def _build_qbo(transactions: List[Dict[str, Any]]) -> str:
-    """Build QBO file matching bank_statement_01_2024.qbo structure"""
-    def _crlf_join(lines):
-        return "\r\n".join(lines) + "\r\n"
-
-    header = _crlf_join([
-        "OFXHEADER:100",
-        "DATA:OFXSGML",
-        "VERSION:102",
-        "SECURITY:NONE",
-        "ENCODING:USASCII",
-        "CHARSET:1252",
-        "COMPRESSION:NONE",
-        "OLDFILEUID:NONE",
-        "NEWFILEUID:NONE",
-        ""
-    ])
-
-    now = datetime.utcnow()
-    dtserver = now.strftime("%Y%m%d%H%M%S")
-    trnuid = uuid.uuid4().hex[:16]
-
-    # Date range
-    if transactions:
-        dates = sorted(t["date"] for t in transactions)
-        dtstart = dates[0].strftime("%Y%m%d")
-        dtend = dates[-1].strftime("%Y%m%d")
-    else:
-        dtstart = now.strftime("%Y%m%d")
-        dtend = now.strftime("%Y%m%d")
-
-    # Calculate ending balance
-    ending_balance = sum(t["amount"] for t in transactions) if transactions else 0.0
-    dtasof = dtend + "120000"
-
-    lines = []
-    lines.append("<OFX>")
-
-    # Sign-on message
-    lines += [
-        "<SIGNONMSGSRSV1><SONRS>",
-        "<STATUS><CODE>0</CODE><SEVERITY>INFO</SEVERITY></STATUS>",
-        f"<DTSERVER>{dtserver}</DTSERVER>",
-        "<LANGUAGE>ENG</LANGUAGE>",
-        f"<FI><ORG>{FI_ORG}</ORG><FID>{FI_FID}</FID></FI>",
-        f"<INTU.BID>{INTU_BID}</INTU.BID>",
-        "</SONRS></SIGNONMSGSRSV1>"
-    ]
-
-    # Banking message
-    lines += [
-        "<BANKMSGSRSV1><STMTTRNRS>",
-        f"<TRNUID>{trnuid}</TRNUID>",
-        "<STATUS><CODE>0</CODE><SEVERITY>INFO</SEVERITY></STATUS>",
-        "<STMTRS>",
-        "<CURDEF>USD</CURDEF>",
-        f"<BANKACCTFROM><BANKID>{BANK_ID}</BANKID><ACCTID>{ACCT_ID}</ACCTID><ACCTTYPE>{ACCT_TYPE}</ACCTTYPE></BANKACCTFROM>",
-        f"<BANKTRANLIST><DTSTART>{dtstart}</DTSTART><DTEND>{dtend}</DTEND>"
-    ]
-
-    # Transactions
-    for t in transactions:
-        trntype = "CREDIT" if t["amount"] > 0 else "DEBIT"
-        dt = t["date"].strftime("%Y%m%d")
-        amt = f"{t['amount']:.2f}"
-        name = (t.get("desc") or "")[:30]  # Maximum 30 characters
-        fitid = _make_fitid(t["date"], name, t["amount"])
-
-        lines += [
-            "<STMTTRN>",
-            f"<TRNTYPE>{trntype}</TRNTYPE>",
-            f"<DTPOSTED>{dt}</DTPOSTED>",
-            f"<TRNAMT>{amt}</TRNAMT>",
-            f"<FITID>{fitid}</FITID>",
-            f"<NAME>{name}</NAME>",
-            "</STMTTRN>"
-        ]
-
-    # Close and add balances
-    lines += [
-        "</BANKTRANLIST>",
-        f"<LEDGERBAL><BALAMT>{ending_balance:.2f}</BALAMT><DTASOF>{dtasof}</DTASOF></LEDGERBAL>",
-        f"<AVAILBAL><BALAMT>{ending_balance:.2f}</BALAMT><DTASOF>{dtasof}</DTASOF></AVAILBAL>",
-        "</STMTRS></STMTTRNRS></BANKMSGSRSV1>",
-    ]
-    lines.append("</OFX>")
-
-    return header + _crlf_join(lines)
-
-def convert_csv_to_qbo(csv_path: str, qbo_path: str):
+def _iter_qbo(transactions: List[Dict[str, Any]]):
+    """QBO byte chunks matching bank_statement_01_2024.qbo structure"""
+    account = _BankStatement(ACCT_ID, bankid=BANK_ID, accttype=ACCT_TYPE)
+    return _iter_ofx(transactions, account, fi_org=FI_ORG, fi_fid=FI_FID,
+                     intu_bid=INTU_BID, name_len=30)  # Maximum 30 characters
+
+def convert_csv_to_qbo(csv_path: str, qbo_path: str, statement_date: str = None):
     """Convert table-3.csv to QBO format"""
     transactions = []
+    statement_end = _statement_end(csv_path, statement_date)
 
     with open(csv_path, 'r', encoding='utf-8') as f:
         reader = csv.reader(f)
@@ -183,7 +96,7 @@ def convert_csv_to_qbo(csv_path: str, qbo_path: str):
             balance = row[5]
 
             # Parse date
-            date_val = _parse_date(date_str)
+            date_val = _parse_date(date_str, statement_end)
             if not date_val:
                 continue
 
@@ -215,12 +128,10 @@ def convert_csv_to_qbo(csv_path: str, qbo_path: str):
 
     print(f"Parsed {len(transactions)} transactions")
 
-    # Build QBO
-    qbo_content = _build_qbo(transactions)
-
-    # Write QBO file
-    with open(qbo_path, 'w', encoding='utf-8') as f:
-        f.write(qbo_content)
+    # Build + write QBO file (binary, so the CRLF line endings are kept as-is)
+    with open(qbo_path, 'wb') as f:
+        for chunk in _iter_qbo(transactions):
+            f.write(chunk)
 
     print(f"QBO file written to: {qbo_path}")
     print(f"Total transactions: {len(transactions)}")
@@ -229,11 +140,13 @@ def convert_csv_to_qbo(csv_path: str, qbo_path: str):
         print(f"Net balance: ${total:.2f}")
 
 if __name__ == "__main__":
-    import os
     script_dir = os.path.dirname(os.path.abspath(__file__))
     base_dir = os.path.dirname(script_dir)
 
-    csv_file = os.path.join(base_dir, "table-3.csv")
-    qbo_file = os.path.join(base_dir, "output", "table-3.qbo")
+    ap = argparse.ArgumentParser(description="Convert a Textract table CSV to QBO")
+    ap.add_argument("csv", nargs="?", default=os.path.join(base_dir, "table-3.csv"))
+    ap.add_argument("qbo", nargs="?", default=os.path.join(base_dir, "output", "table-3.qbo"))
+    ap.add_argument("--statement-date", help="statement period's last day (YYYY-MM-DD), the year for m/d dates")
+    args = ap.parse_args()
 
-    convert_csv_to_qbo(csv_file, qbo_file)
+    convert_csv_to_qbo(args.csv, args.qbo, args.statement_date)
@@ -9,7 +9,18 @@ if (Test-Path $zipPath) {
     Remove-Item $zipPath
 }
 
-Compress-Archive -Path "lambda_function.py" -DestinationPath $zipPath
+# Ship bytecode too: /var/task is read-only, so otherwise every cold start recompiles the source.
+# The .pyc is only picked up when this Python's minor version matches the Lambda runtime.
+# checked-hash: a .pyc that no longer matches the source hash is ignored, never run stale.
+if (Test-Path "__pycache__") {
+    Remove-Item "__pycache__" -Recurse
+}
+$packagePaths = @("lambda_function.py")
+python -m compileall -q --invalidation-mode checked-hash lambda_function.py
+if ($LASTEXITCODE -eq 0) {
+    $packagePaths += "__pycache__"
+}
+Compress-Archive -Path $packagePaths -DestinationPath $zipPath
 
 Write-Host "ZIP file created: $zipPath" -ForegroundColor Green
 
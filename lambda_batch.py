@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+Batch reprocessing for stored statements, without Lambda or Textract.
+Takes block dumps written with SAVE_BLOCKS (*.blocks.jsonl.gz) and/or table
+CSVs (the Lambda's *.tables.csv or Textract console exports like table-3.csv),
+runs transaction extraction + QBO building for each on a process pool, and
+writes <name>.qbo files atomically into the output directory. A Textract
+console export folder (rawText.txt plus table-*.csv) is one statement with
+one output, named after the folder; files without transactions get no QBO.
+Inputs with the same name in different folders get those folders prefixed
+(jan-stmt.qbo, feb-stmt.qbo).
+PDFs named explicitly are read from their text layer (needs pypdf):
+
+    python lambda_batch.py statements/ -o qbo/ --workers 8
+    python lambda_batch.py --manifest files.txt -o qbo/ --account-type credit-card
+    python lambda_batch.py Feb.pdf Mar.pdf -o qbo/
+"""
+import argparse
+import csv
+import glob
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Dict, List
+
+import lambda_function as lf
+
+_SUFFIXES = (".blocks.jsonl.gz", ".tables.csv", ".csv")
+_EXPORT_TABLE_RE = re.compile(r"table-(\d+)\.csv$", re.I)
+
+
+def _stem(path: str) -> str:
+    name = os.path.basename(os.path.normpath(path))
+    for suffix in _SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name.rsplit(".", 1)[0]
+
+
+def output_names(paths: List[str]) -> Dict[str, str]:
+    """
+    Output name (without .qbo) per input: its stem, or for stems shared by
+    several inputs, the folders that tell them apart joined in front
+    (coll/jan/stmt.tables.csv -> "jan-stmt"), so no output overwrites another.
+    """
+    groups: Dict[str, List[str]] = {}
+    for p in paths:
+        groups.setdefault(_stem(p), []).append(p)
+    names, taken = {}, set()
+    for stem, group in groups.items():
+        dirs = [os.path.dirname(os.path.abspath(os.path.normpath(p))) for p in group]
+        common = os.path.commonpath(dirs)
+        for p, d in zip(group, dirs):
+            rel = os.path.relpath(d, common) if len(group) > 1 else "."
+            name = stem if rel == "." else f"{rel.replace(os.sep, '-')}-{stem}"
+            # Same folder and stem (stmt.csv next to stmt.tables.csv): number the rest
+            base, n = name, 1
+            while name in taken:
+                n += 1
+                name = f"{base}-{n}"
+            taken.add(name)
+            names[p] = name
+    return names
+
+
+def read_table_csv(path: str) -> List[List[List[str]]]:
+    """
+    Splits a tables CSV into grids. Sections start at the Lambda's "#TABLE n"
+    markers or after blank rows; Textract export quoting ("'1/2") is removed
+    and "Confidence Scores" sections are skipped.
+    """
+    grids, grid, skipping = [], [], False
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        for row in csv.reader(f):
+            row = [c[1:] if c.startswith("'") else c for c in row]
+            first = row[0].strip() if row else ""
+            if not any(c.strip() for c in row) or first.startswith("#TABLE") or first.startswith("Confidence"):
+                if grid:
+                    grids.append(grid)
+                grid = []
+                skipping = first.startswith("Confidence")
+                continue
+            if not skipping and not first.startswith("#NO_TABLES_FOUND"):
+                grid.append(row)
+    if grid:
+        grids.append(grid)
+    return grids
+
+
+def is_export_dir(path: str) -> bool:
+    """A Textract console export: rawText.txt next to table-N.csv files."""
+    return (os.path.isdir(path) and os.path.exists(os.path.join(path, "rawText.txt"))
+            and any(_EXPORT_TABLE_RE.match(f) for f in os.listdir(path)))
+
+
+def read_export_dir(path: str) -> List[List[List[str]]]:
+    """Grids of an export folder's table-N.csv files, in table order."""
+    tables = sorted((int(m.group(1)), f) for f in os.listdir(path) for m in [_EXPORT_TABLE_RE.match(f)] if m)
+    return [g for _, f in tables for g in read_table_csv(os.path.join(path, f))]
+
+
+def load_transactions(path: str, account_type: str = "bank", account_number: str = "",
+                      header_profile: str = None, statement_date: str = None) -> Dict[str, Any]:
+    """
+    Parses one block dump, tables CSV, export folder or text-layer PDF. Returns {"grids",
+    "transactions", "balances", "account_type", "account_number"}; dumps
+    override the account, header profile and statement date from their stored
+    upload metadata. Without a statement date the period is read from page 1
+    of a dump or PDF, or for an export folder or CSV from the rawText.txt in
+    (or beside) it.
+    """
+    if path.endswith(".blocks.jsonl.gz"):
+        with open(path, "rb") as f:
+            header, pages = lf._read_block_dump(f)
+            meta = header.get("metadata") or {}
+            period = lf._StatementPeriod(lf._parse_date(meta.get("statementdate", statement_date or "")))
+            grids = [g for _, g in lf._stream_tables(period.tap(pages))]
+        account_type = meta.get("accounttype", account_type)
+        account_number = meta.get("accountnumber", account_number)
+        header_profile = meta.get("headerprofile", header_profile)
+    elif path.lower().endswith(".pdf"):
+        with open(path, "rb") as f:
+            layer = lf._text_layer_pages(f.read(), lf._header_matcher(header_profile))
+        if layer is None:
+            raise ValueError("not a readable PDF, or pypdf missing; needs Textract")
+        pages, scanned = layer
+        if scanned:
+            raise ValueError(f"scanned pages {scanned} need Textract")
+        period = lf._StatementPeriod(lf._parse_date(statement_date or ""))
+        grids = [g for _, g in lf._stream_tables(period.tap(pages))]
+    else:
+        export = os.path.isdir(path)
+        grids = read_export_dir(path) if export else read_table_csv(path)
+        period = lf._StatementPeriod(lf._parse_date(statement_date or ""))
+        raw_text = os.path.join(path if export else os.path.dirname(path), "rawText.txt")
+        if not period.done and os.path.exists(raw_text):
+            with open(raw_text, encoding="utf-8-sig") as f:
+                period.read_lines(f)
+
+    schema = lf._TableSchema(header_profile, period)
+    txns, balances = [], {}
+    for grid in grids:
+        is_txn = not lf.CLASSIFY_TABLES or lf._is_transaction_table(grid, headers=schema.headers)
+        found = lf._rows_to_transactions(grid, schema) if is_txn else []
+        if found:
+            txns.extend(found)
+        else:
+            lf._statement_balances(grid, balances)
+    return {"grids": grids, "transactions": txns, "balances": balances,
+            "account_type": account_type, "account_number": account_number}
+
+
+def process_one(path: str, out_path: str, account_type: str, account_number: str,
+                header_profile: str = None, statement_date: str = None) -> Dict[str, Any]:
+    """
+    Worker: one input -> one QBO at `out_path`, or none when it holds no
+    transactions ("skipped"). Returns a summary record (never raises).
+    """
+    t0 = time.perf_counter()
+    rec = {"input": path, "ok": False, "skipped": False, "tables": 0, "transactions": 0, "reconciled": False}
+    try:
+        st = load_transactions(path, account_type, account_number, header_profile, statement_date)
+        txns = st["transactions"]
+        if not txns:
+            rec.update(ok=True, skipped=True, tables=len(st["grids"]))
+            rec["seconds"] = round(time.perf_counter() - t0, 3)
+            return rec
+        recon = lf._reconcile(txns, st["balances"].get("opening"), st["balances"].get("closing"))
+        account = lf._qbo_account(st["account_type"], st["account_number"])
+        with lf._FileWriter(out_path) as out:
+            for chunk in lf._iter_ofx(txns, account, ledger_balance=recon["closing"]):
+                out.write(chunk)
+        rec.update(ok=True, output=out_path, tables=len(st["grids"]), transactions=len(txns),
+                   reconciled=recon["reconciled"], balance_gaps=len(recon["gaps"]))
+    except Exception as e:
+        rec["error"] = f"{type(e).__name__}: {e}"
+    rec["seconds"] = round(time.perf_counter() - t0, 3)
+    return rec
+
+
+def collect_inputs(paths: List[str], manifest: str = None) -> List[str]:
+    """
+    Expands directories to their dumps/CSVs and appends manifest entries (one
+    path per line, relative to the manifest). A Textract export folder stands
+    for all of its CSVs. Duplicates are dropped.
+    """
+    found = []
+    exports: Dict[str, bool] = {}
+    for p in paths:
+        if os.path.isdir(p) and not is_export_dir(p):
+            for suffix in (".blocks.jsonl.gz", ".csv"):
+                for f in sorted(glob.glob(os.path.join(p, "**", f"*{suffix}"), recursive=True)):
+                    d = os.path.dirname(f)
+                    if suffix == ".csv" and exports.setdefault(d, is_export_dir(d)):
+                        f = d
+                    found.append(f)
+        else:
+            found.append(p)
+    if manifest:
+        base = os.path.dirname(os.path.abspath(manifest))
+        with open(manifest, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    found.append(line if os.path.isabs(line) else os.path.join(base, line))
+    # A dump and the tables CSV written alongside it are the same statement; keep the dump
+    dumps = {p[:-len(".blocks.jsonl.gz")] for p in found if p.endswith(".blocks.jsonl.gz")}
+    seen = set()
+    return [p for p in found
+            if not (p.endswith(".tables.csv") and p[:-len(".tables.csv")] in dumps)
+            and not (p in seen or seen.add(p))]
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("inputs", nargs="*", help="files or directories")
+    ap.add_argument("--manifest", help="text file listing inputs, one per line")
+    ap.add_argument("-o", "--out-dir", default="qbo-out")
+    ap.add_argument("--workers", type=int, default=os.cpu_count())
+    ap.add_argument("--account-type", default="bank", choices=("bank", "credit-card"),
+                    help="for CSV inputs; dumps use their stored metadata")
+    ap.add_argument("--account-number", default="")
+    ap.add_argument("--header-profile", help=f"header vocabulary (default {lf.HEADER_PROFILE})")
+    ap.add_argument("--statement-date", help="statement period's last day (YYYY-MM-DD), the year for m/d dates")
+    args = ap.parse_args()
+
+    inputs = collect_inputs(args.inputs, args.manifest)
+    if not inputs:
+        ap.error("no inputs found")
+    os.makedirs(args.out_dir, exist_ok=True)
+    names = output_names(inputs)
+
+    t0 = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = [pool.submit(process_one, p, os.path.join(args.out_dir, f"{names[p]}.qbo"),
+                               args.account_type, args.account_number,
+                               args.header_profile, args.statement_date)
+                   for p in inputs]
+        for fut in as_completed(futures):
+            results.append(fut.result())
+    elapsed = time.perf_counter() - t0
+
+    results.sort(key=lambda r: r["input"])
+    print(f"{'status':<6} {'tables':>6} {'txns':>6} {'bal':>4} {'sec':>7}  input")
+    for r in results:
+        status = "FAIL" if not r["ok"] else ("skip" if r["skipped"] else "ok")
+        bal = "ok" if r["reconciled"] else ("gap" if r.get("balance_gaps") else "-")
+        print(f"{status:<6} {r['tables']:>6} {r['transactions']:>6} {bal:>4} {r['seconds']:>7.2f}  {r['input']}")
+        if not r["ok"]:
+            print(f"{'':<6} {r['error']}")
+    failed = sum(not r["ok"] for r in results)
+    skipped = sum(r["skipped"] for r in results)
+    total_txns = sum(r["transactions"] for r in results)
+    print(f"\n{len(results) - failed - skipped}/{len(results)} inputs written, {skipped} skipped (no transactions), "
+          f"{total_txns} transactions in {elapsed:.2f}s "
+          f"({len(results) / elapsed:.1f} inputs/s, {args.workers} workers) -> {args.out_dir}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,509 @@
+#!/usr/bin/env python3
+"""
+Offline benchmarks for lambda_function.py.
+Runs against local stand-ins for the AWS clients, so no credentials or
+Textract jobs are needed:
+
+    python lambda_bench.py stages --sizes 1 10 100 1000
+    python lambda_bench.py prefetch --pages 40 --fetch-ms 120 --parse-ms 80
+    python lambda_bench.py startup --runs 20
+    python lambda_bench.py batch --jobs 10 --workers 4 --fetch-ms 120
+    python lambda_bench.py async --pages 5 --fetch-ms 120 --s3-ms 40
+    python lambda_bench.py fitid --statements 2000 --rows 500
+"""
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List
+
+os.environ.setdefault("OUTPUT_BUCKET", "bench-output")
+
+import lambda_function as lf
+
+
+class StubTextract:
+    """
+    Stand-in for the boto3 Textract client that serves pre-built
+    GetDocumentAnalysis pages, sleeping `latency` seconds per call.
+    `throttle_every` makes every Nth call raise a ThrottlingException first.
+    """
+
+    class ThrottlingError(Exception):
+        def __init__(self):
+            super().__init__("Rate exceeded")
+            self.response = {"Error": {"Code": "ThrottlingException"}}
+
+    def __init__(self, pages: List[Dict[str, Any]], latency: float = 0.0, throttle_every: int = 0):
+        self.pages = pages
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.calls = 0
+
+    def get_document_analysis(self, JobId: str, NextToken: str = None):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.throttle_every and self.calls % self.throttle_every == 0:
+            raise self.ThrottlingError()
+        n = int(NextToken or 0)
+        res = dict(self.pages[n])
+        if n + 1 < len(self.pages):
+            res["NextToken"] = str(n + 1)
+        return res
+
+
+class StubS3:
+    """
+    Stand-in for the boto3 S3 client: head_object serves `metadata`, puts land
+    in `objects`. Every call sleeps `latency` seconds.
+    """
+
+    def __init__(self, metadata: Dict[str, str] = None, latency: float = 0.0):
+        self.metadata = metadata or {"accounttype": "bank", "accountnumber": "000123"}
+        self.objects: Dict[str, bytes] = {}
+        self.latency = latency
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def head_object(self, Bucket: str, Key: str):
+        self._wait()
+        return {"Metadata": dict(self.metadata), "ETag": '"bench"', "ContentLength": 0}
+
+    class NoSuchKey(Exception):
+        def __init__(self, key):
+            super().__init__(f"NoSuchKey: {key}")
+            self.response = {"Error": {"Code": "NoSuchKey"}}
+
+    def get_object(self, Bucket: str, Key: str):
+        self._wait()
+        if f"{Bucket}/{Key}" not in self.objects:
+            raise self.NoSuchKey(Key)
+        return {"Body": io.BytesIO(self.objects[f"{Bucket}/{Key}"])}
+
+    def put_object(self, Bucket: str, Key: str, Body: bytes, **kw):
+        self._wait()
+        self.objects[f"{Bucket}/{Key}"] = Body
+        return {"ETag": '"bench"'}
+
+    def create_multipart_upload(self, Bucket: str, Key: str, **kw):
+        self._wait()
+        self.objects[f"{Bucket}/{Key}"] = b""
+        return {"UploadId": f"upload-{Key}"}
+
+    def upload_part(self, Bucket: str, Key: str, UploadId: str, PartNumber: int, Body: bytes):
+        self._wait()
+        self.objects[f"{Bucket}/{Key}"] += Body
+        return {"ETag": f'"part-{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket: str, Key: str, UploadId: str, MultipartUpload: Dict[str, Any]):
+        self._wait()
+        return {"Location": f"s3://{Bucket}/{Key}"}
+
+    def abort_multipart_upload(self, Bucket: str, Key: str, UploadId: str):
+        self._wait()
+        self.objects.pop(f"{Bucket}/{Key}", None)
+
+
+# ---------- Synthetic Textract output ----------
+_PAYEES = ["Purchase authorized on {d} Lowe's #2707 Homestead FL", "Online Transfer to Everyday Checking",
+           "ATM Withdrawal authorized on {d}", "Non-Wells Fargo ATM Transaction Fee", "eDeposit IN Branch {d}",
+           "Apple.Com/Bill 866-712-7753 CA", "Circle K 02384 Homestead FL"]
+
+
+def make_statement_pages(n_pages: int, rows: int = 30, seed: int = 7,
+                         blocks_per_result: int = 1000) -> List[Dict[str, Any]]:
+    """
+    Builds GetDocumentAnalysis result pages for an n-page statement.
+    Every document page carries a PAGE block, LINE/WORD text and one
+    transaction TABLE (header row only on the first page, like real
+    continuation tables); page 1 also has a small summary table. Blocks are
+    split into results of `blocks_per_result`, as Textract paginates them.
+    """
+    rnd = random.Random(seed)
+    blocks: List[Dict[str, Any]] = []
+    counter = [0]
+
+    def nid():
+        counter[0] += 1
+        return f"b-{counter[0]:08d}"
+
+    def words(text, page):
+        out = []
+        for w in text.split():
+            out.append({"BlockType": "WORD", "Id": nid(), "Text": w, "Page": page})
+        blocks.extend(out)
+        return [w["Id"] for w in out]
+
+    def table(grid, page):
+        cells = []
+        for r, row in enumerate(grid, 1):
+            for c, text in enumerate(row, 1):
+                cells.append({"BlockType": "CELL", "Id": nid(), "RowIndex": r, "ColumnIndex": c,
+                              "RowSpan": 1, "ColumnSpan": 1, "Page": page,
+                              "Relationships": [{"Type": "CHILD", "Ids": words(text, page)}]})
+        blocks.append({"BlockType": "TABLE", "Id": nid(), "Page": page,
+                       "Relationships": [{"Type": "CHILD", "Ids": [c["Id"] for c in cells]}]})
+        blocks.extend(cells)
+
+    day = datetime(2024, 1, 2)
+    balance = 5000.0
+    for page in range(1, n_pages + 1):
+        blocks.append({"BlockType": "PAGE", "Id": nid(), "Page": page})
+        for line in ("Initiate Business Checking", f"Page {page} of {n_pages}"):
+            blocks.append({"BlockType": "LINE", "Id": nid(), "Text": line, "Page": page,
+                           "Relationships": [{"Type": "CHILD", "Ids": words(line, page)}]})
+        if page == 1:
+            table([["Beginning balance", f"{balance:,.2f}"], ["Deposits/Credits", "0.00"],
+                   ["Withdrawals/Debits", "0.00"]], page)
+        grid = [["Date", "Description", "Amount", "Balance"]] if page == 1 else []
+        for _ in range(rows):
+            day += timedelta(days=rnd.random() < 0.3)
+            amt = round(rnd.uniform(-900, 600), 2)
+            balance += amt
+            amt_txt = f"({abs(amt):,.2f})" if amt < 0 else f"{amt:,.2f}"
+            desc = rnd.choice(_PAYEES).format(d=day.strftime("%m/%d"))
+            grid.append([day.strftime("%m/%d/%Y"), desc, amt_txt, f"{balance:,.2f}"])
+        table(grid, page)
+
+    return [{"Blocks": blocks[i:i + blocks_per_result]}
+            for i in range(0, len(blocks), blocks_per_result)] or [{"Blocks": []}]
+
+
+# ---------- Stage benchmarks ----------
+def _peak_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def _measure(fn: Callable[[], Any]):
+    """Returns (result, seconds, peak traced MiB); timed and traced in separate runs."""
+    t0 = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - t0
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak / (1024 * 1024)
+
+
+def bench_stages(n_pages: int, rows: int = 30) -> List[Dict[str, Any]]:
+    """Times each lambda_handler stage, then the whole handler, on an n-page synthetic statement."""
+    pages = make_statement_pages(n_pages, rows)
+    n_blocks = sum(len(p["Blocks"]) for p in pages)
+    out = []
+
+    def record(stage, items, unit, elapsed, peak):
+        out.append({"pages": n_pages, "stage": stage, "items": items, "unit": unit,
+                    "seconds": round(elapsed, 6), "per_sec": round(items / elapsed, 1) if elapsed else None,
+                    "peak_traced_mb": round(peak, 2), "peak_rss_mb": round(_peak_rss_mb(), 1)})
+
+    def fetch():
+        return [b for p in lf._iter_pages("bench-job", StubTextract(pages)) for b in p["Blocks"]]
+    blocks, el, pk = _measure(fetch)
+    record("page_fetch", n_blocks, "blocks", el, pk)
+
+    grids, el, pk = _measure(lambda: [g for _, g in lf._tables_from_blocks(blocks)])
+    record("tables_from_blocks", n_blocks, "blocks", el, pk)
+    del blocks
+
+    grids2, el, pk = _measure(lambda: [g for _, g in lf._stream_tables(pages)])
+    record("stream_tables", n_blocks, "blocks", el, pk)
+    del grids2
+
+    n_rows = sum(len(g) for g in grids)
+    kept, el, pk = _measure(lambda: [g for g in grids if lf._is_transaction_table(g)])
+    record("classify_tables", len(grids), "tables", el, pk)
+    del kept
+
+    def extract():
+        schema = lf._TableSchema()
+        return [t for g in grids for t in lf._rows_to_transactions(g, schema)]
+    txns, el, pk = _measure(extract)
+    record("rows_to_transactions", n_rows, "rows", el, pk)
+
+    def write_csv():
+        buf = io.StringIO()
+        w = csv.writer(buf)
+        for g in grids:
+            w.writerows(g)
+        return buf.getvalue().encode("utf-8-sig")
+    _, el, pk = _measure(write_csv)
+    record("csv_write", n_rows, "rows", el, pk)
+
+    _, el, pk = _measure(lambda: lf._build_bank_qbo(txns, "000123"))
+    record("build_bank_qbo", len(txns), "txns", el, pk)
+
+    def handler():
+        lf.s3, lf.tx = StubS3(), StubTextract(pages)
+        lf.RESULT_CACHE = False
+        with contextlib.redirect_stdout(io.StringIO()):
+            return lf.lambda_handler({"JobId": "bench-job"}, None)
+    _, el, pk = _measure(handler)
+    record("lambda_handler", n_blocks, "blocks", el, pk)
+    return out
+
+
+def bench_prefetch(pages: int, fetch_ms: float, parse_ms: float, depth: int) -> Dict[str, float]:
+    """Wall-clock time for sequential vs prefetched paging with a simulated parse step."""
+    docs = [{"Blocks": []} for _ in range(pages)]
+    results = {}
+    for name in ("sequential", "prefetch"):
+        client = StubTextract(docs, latency=fetch_ms / 1000)
+        if name == "sequential":
+            it = lf._iter_pages("bench-job", client)
+        else:
+            it = lf._prefetch_pages("bench-job", depth, client)
+        t0 = time.perf_counter()
+        for _ in it:
+            time.sleep(parse_ms / 1000)
+        results[name] = time.perf_counter() - t0
+    results["ideal"] = pages * max(fetch_ms, parse_ms) / 1000
+    return results
+
+
+def bench_batch(jobs: int, pages: int, fetch_ms: float, workers: int) -> Dict[str, float]:
+    """Wall-clock time for one SQS batch of `jobs` completed jobs, one worker vs `workers`."""
+    docs = make_statement_pages(pages)
+    records = [{"eventSource": "aws:sqs", "messageId": f"msg-{i}",
+                "body": json.dumps({"JobId": f"bench-job-{i}", "Status": "SUCCEEDED",
+                                    "DocumentLocation": {"S3Bucket": "bench-input",
+                                                         "S3ObjectName": f"incoming/statement-{i}.pdf"}})}
+               for i in range(jobs)]
+    lf.RESULT_CACHE = False
+    results = {}
+    for name, n in (("sequential", 1), (f"{workers} workers", workers)):
+        lf.s3, lf.tx = StubS3(), StubTextract(docs, latency=fetch_ms / 1000)
+        lf.BATCH_WORKERS = n
+        t0 = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            out = lf.batch_handler({"Records": records}, None)
+        results[name] = time.perf_counter() - t0
+        if out["batchItemFailures"]:
+            raise RuntimeError(f"batch failures: {out['batchItemFailures']}")
+    return results
+
+
+def bench_async(pages: int, fetch_ms: float, s3_ms: float, runs: int) -> Dict[str, float]:
+    """Median end-to-end latency of lambda_handler vs async_handler against slow stand-in clients."""
+    docs = make_statement_pages(pages)
+    lf.RESULT_CACHE = True  # include the cache lookup/put round trips
+    results = {}
+    for name, handler in (("lambda_handler", lf.lambda_handler), ("async_handler", lf.async_handler)):
+        times = []
+        for i in range(runs):
+            lf.s3 = StubS3(latency=s3_ms / 1000)
+            lf.tx = StubTextract(docs, latency=fetch_ms / 1000)
+            t0 = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                out = handler({"JobId": f"bench-job-{i}"}, None)
+            times.append(time.perf_counter() - t0)
+            if out.get("cached"):
+                raise RuntimeError("unexpected cache hit")
+        results[name] = statistics.median(times)
+    return results
+
+
+def make_ledger(statements: int, rows: int, seed: int = 11) -> List[List[Dict[str, Any]]]:
+    """Monthly statements of synthetic transactions, with same-day repeats such as ATM fees."""
+    rnd = random.Random(seed)
+    start = datetime(2015, 1, 1)
+    out = []
+    for s in range(statements):
+        month = start + timedelta(days=30 * s)
+        txns = []
+        for _ in range(rows):
+            day = month + timedelta(days=rnd.randrange(30))
+            if rnd.random() < 0.1:
+                desc, amt = "Non-Wells Fargo ATM Transaction Fee", -2.50
+            else:
+                desc = rnd.choice(_PAYEES).format(d=day.strftime("%m/%d"))
+                amt = round(rnd.uniform(-400, 400), 2)
+            txns.append({"date": day, "desc": desc[:32], "amount": amt})
+        out.append(txns)
+    return out
+
+
+def bench_fitid(statements: int, rows: int) -> Dict[str, Any]:
+    """
+    FITID throughput of the old scheme (md5, no occurrence counter) vs
+    _iter_fitids, the same-statement repeats each one merges, and hash
+    collisions between distinct transactions across the whole ledger.
+    """
+    ledger = make_ledger(statements, rows)
+    n = statements * rows
+
+    def legacy():
+        import hashlib
+        return [[hashlib.md5(f"{t['date']:%Y%m%d}{t['amount']:.2f}{t['desc']}".encode("utf-8")).hexdigest()[:12]
+                 for t in txns] for txns in ledger]
+
+    def current():
+        return [list(lf._iter_fitids(txns)) for txns in ledger]
+
+    results = {"transactions": n}
+    for name, fn in (("md5", legacy), ("iter_fitids", current)):
+        t0 = time.perf_counter()
+        ids = fn()
+        results[f"{name}_ns_per_txn"] = (time.perf_counter() - t0) / n * 1e9
+        results[f"{name}_merged_repeats"] = sum(len(s) - len(set(s)) for s in ids)
+        # distinct (statement, date, desc, amount, occurrence) keys sharing a FITID anywhere in the ledger
+        owner: Dict[str, tuple] = {}
+        collisions = 0
+        for si, (txns, fitids) in enumerate(zip(ledger, ids)):
+            seen: Dict[tuple, int] = {}
+            for t, fitid in zip(txns, fitids):
+                k = (t["date"], t["desc"], t["amount"])
+                seen[k] = seen.get(k, 0) + 1
+                key = k + (seen[k],)
+                if owner.setdefault(fitid, key) != key:
+                    collisions += 1
+        results[f"{name}_collisions"] = collisions
+    return results
+
+
+_STARTUP_PROBE = """
+import sys, time
+sys.path.insert(0, {root!r})
+t0 = time.perf_counter()
+import lambda_function as lf
+t1 = time.perf_counter()
+try:
+    lf._s3(); lf._textract()
+    clients = time.perf_counter() - t1
+except ImportError:
+    clients = -1.0
+print(t1 - t0, clients)
+"""
+
+
+def bench_startup(runs: int, top: int = 10) -> Dict[str, Any]:
+    """
+    Cold import of lambda_function in fresh interpreters (no OUTPUT_BUCKET, no
+    AWS config), plus the cost of creating both clients on first use when boto3
+    is installed. "source" compiles lambda_function.py on every run, as on a
+    Lambda that ships only the .py; "pyc" reads bytecode compiled beforehand.
+    The slowest modules come from one -X importtime run.
+    """
+    import shutil
+    import tempfile
+    env = {k: v for k, v in os.environ.items() if k not in ("OUTPUT_BUCKET", "PYTHONDONTWRITEBYTECODE")}
+    result: Dict[str, Any] = {}
+    clients = []
+    with tempfile.TemporaryDirectory() as root:
+        # A private copy, so only its own __pycache__ decides source vs pyc
+        shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), "lambda_function.py"), root)
+        probe = _STARTUP_PROBE.format(root=root)
+        for name, flags in (("source", ["-B"]), ("pyc", [])):
+            if name == "pyc":
+                subprocess.run([sys.executable, "-m", "py_compile", os.path.join(root, "lambda_function.py")],
+                               env=env, check=True)
+            imports = []
+            for _ in range(runs):
+                out = subprocess.run([sys.executable, *flags, "-c", probe], env=env,
+                                     check=True, capture_output=True, text=True).stdout.split()
+                imports.append(float(out[0]))
+                if float(out[1]) >= 0:
+                    clients.append(float(out[1]))
+            result[f"import_{name}_ms"] = statistics.median(imports) * 1000
+
+        trace = subprocess.run([sys.executable, "-X", "importtime", "-c", "import lambda_function"], cwd=root,
+                               env=env, check=True, capture_output=True, text=True).stderr
+    modules = []
+    for line in trace.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[0].startswith("import time:") and parts[1].strip().isdigit():
+            modules.append((int(parts[1]), parts[2].strip()))
+    modules.sort(reverse=True)
+    result["clients_ms"] = statistics.median(clients) * 1000 if clients else None
+    result["slowest"] = [(name, us / 1000) for us, name in modules[:top]]
+    return result
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("stages", help="throughput and memory of each lambda_handler stage")
+    p.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 100, 1000])
+    p.add_argument("--rows", type=int, default=30, help="transaction rows per page")
+    p.add_argument("--json", action="store_true", help="emit JSON lines instead of a table")
+    p = sub.add_parser("prefetch", help="overlap of page fetch and parse")
+    p.add_argument("--pages", type=int, default=40)
+    p.add_argument("--fetch-ms", type=float, default=120)
+    p.add_argument("--parse-ms", type=float, default=80)
+    p.add_argument("--depth", type=int, default=lf.PREFETCH_PAGES or 2)
+    p = sub.add_parser("startup", help="cold import time and first-use client creation")
+    p.add_argument("--runs", type=int, default=20)
+    p.add_argument("--top", type=int, default=10, help="slowest modules to list (cumulative)")
+    p = sub.add_parser("batch", help="SQS batch of completed jobs, sequential vs thread pool")
+    p.add_argument("--jobs", type=int, default=10)
+    p.add_argument("--pages", type=int, default=3, help="result pages per job")
+    p.add_argument("--fetch-ms", type=float, default=120)
+    p.add_argument("--workers", type=int, default=lf.BATCH_WORKERS)
+    p = sub.add_parser("async", help="latency of lambda_handler vs async_handler")
+    p.add_argument("--pages", type=int, default=5, help="result pages per job")
+    p.add_argument("--fetch-ms", type=float, default=120, help="latency per GetDocumentAnalysis call")
+    p.add_argument("--s3-ms", type=float, default=40, help="latency per S3 call")
+    p.add_argument("--runs", type=int, default=5)
+    p = sub.add_parser("fitid", help="FITID speed, merged repeats and collisions on a synthetic ledger")
+    p.add_argument("--statements", type=int, default=2000)
+    p.add_argument("--rows", type=int, default=500, help="transactions per statement")
+    args = ap.parse_args()
+
+    if args.cmd == "stages":
+        if not args.json:
+            print(f"{'pages':>6} {'stage':<22} {'items':>9} {'seconds':>9} {'per sec':>12} {'traced MB':>10} {'RSS MB':>8}")
+        for n in sorted(args.sizes):
+            for r in bench_stages(n, args.rows):
+                if args.json:
+                    print(json.dumps(r))
+                else:
+                    print(f"{r['pages']:>6} {r['stage']:<22} {r['items']:>9} {r['seconds']:>9.3f} "
+                          f"{(r['per_sec'] or 0):>8.0f} {r['unit']:<3} {r['peak_traced_mb']:>10.1f} {r['peak_rss_mb']:>8.1f}")
+    elif args.cmd == "prefetch":
+        r = bench_prefetch(args.pages, args.fetch_ms, args.parse_ms, args.depth)
+        for k, v in r.items():
+            print(f"{k:>10}: {v:8.3f}s")
+    elif args.cmd == "batch":
+        r = bench_batch(args.jobs, args.pages, args.fetch_ms, args.workers)
+        for k, v in r.items():
+            print(f"{k:>12}: {v:8.3f}s ({args.jobs / v:.1f} jobs/s)")
+    elif args.cmd == "async":
+        r = bench_async(args.pages, args.fetch_ms, args.s3_ms, args.runs)
+        for k, v in r.items():
+            print(f"{k:>15}: {v:8.3f}s")
+    elif args.cmd == "fitid":
+        r = bench_fitid(args.statements, args.rows)
+        print(f"{r['transactions']} transactions in {args.statements} statements")
+        print(f"{'scheme':<12} {'ns/txn':>8} {'repeats merged':>15} {'collisions':>11}")
+        for name in ("md5", "iter_fitids"):
+            print(f"{name:<12} {r[name + '_ns_per_txn']:>8.0f} {r[name + '_merged_repeats']:>15} "
+                  f"{r[name + '_collisions']:>11}")
+    elif args.cmd == "startup":
+        r = bench_startup(args.runs, args.top)
+        print(f"import lambda_function: {r['import_source_ms']:8.1f} ms from source, "
+              f"{r['import_pyc_ms']:.1f} ms from pyc (median of {args.runs})")
+        if r["clients_ms"] is None:
+            print("first-use clients:      boto3 not installed")
+        else:
+            print(f"first-use clients:      {r['clients_ms']:8.1f} ms")
+        print("slowest imports (cumulative):")
+        for name, ms in r["slowest"]:
+            print(f"  {ms:8.1f} ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
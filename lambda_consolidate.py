@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+Consolidates statements into one running ledger per account and writes a
+combined QBO for each account. Inputs are block dumps and tables CSVs (as in
+lambda_batch.py) and existing .qbo/.ofx files:
+
+    python lambda_consolidate.py statements/ --ledger ledger.db -o combined/
+    python lambda_consolidate.py Jan.qbo Feb.qbo --ledger ledger.db --account-number 891536836
+    python lambda_consolidate.py --ledger ledger.db -o combined/     # re-emit only
+
+The ledger is a SQLite file keyed by (account, FITID), with the FITID built
+by _iter_fitids from each transaction's date, name, amount and occurrence
+within its statement; .qbo/.ofx inputs keep the <FITID> in the file, so
+re-importing a QBO (ours or the bank's) lands on the rows it already made.
+A transaction that appears in two overlapping statements has the same key
+and is stored once.
+Merging a statement costs one indexed insert per transaction, whatever the
+ledger's size, and a file already merged with the same size and mtime is skipped.
+Each statement's reconciled closing balance is kept too; a combined QBO's
+LEDGERBAL is the latest one plus anything posted after it.
+An input without transactions is reported as "skip" and not recorded, so it is
+read again next run (month/day-only CSVs need --statement-date or a rawText.txt).
+"""
+import argparse
+import os
+import re
+import sqlite3
+import sys
+import time
+from datetime import datetime
+from decimal import Decimal
+from typing import Any, Dict, Iterator, List, Tuple
+
+import lambda_function as lf
+from lambda_batch import collect_inputs, load_transactions
+
+_STMTTRN_RE = re.compile(r"<STMTTRN>(.*?)</STMTTRN>", re.S | re.I)
+_TAG_RE = re.compile(r"<(DTPOSTED|TRNAMT|NAME|MEMO|FITID)>([^<\r\n]*)", re.I)
+_ACCTID_RE = re.compile(r"<ACCTID>([^<\r\n]*)", re.I)
+_LEDGERBAL_RE = re.compile(r"<LEDGERBAL>\s*<BALAMT>([^<\r\n]*)", re.I)
+
+
+def read_qbo(path: str, name_len: int = 32) -> Dict[str, Any]:
+    """
+    Transactions of an OFX/QBO file, with amounts in the parser's sign
+    convention: credit card TRNAMTs are negated back, so that
+    _CreditCardStatement writes them out unchanged. The file's FITIDs are
+    kept and become the ledger keys, and its LEDGERBAL is the closing balance.
+    """
+    with open(path, encoding="utf-8", errors="replace") as f:
+        text = f.read()
+    credit_card = "<CCACCTFROM>" in text.upper()
+    m = _ACCTID_RE.search(text)
+    balances = {}
+    bal = _LEDGERBAL_RE.search(text)
+    try:
+        if bal:
+            balances["closing"] = Decimal(bal.group(1).strip())
+    except ArithmeticError:
+        pass
+    txns = []
+    for body in _STMTTRN_RE.findall(text):
+        tags = {k.upper(): v.strip() for k, v in _TAG_RE.findall(body)}
+        try:
+            date = datetime.strptime(tags["DTPOSTED"][:8], "%Y%m%d")
+            amount = Decimal(tags["TRNAMT"])
+        except (KeyError, ValueError, ArithmeticError):
+            continue
+        txns.append({
+            "date": date,
+            "desc": (tags.get("NAME") or tags.get("MEMO") or "")[:name_len],
+            "amount": -amount if credit_card else amount,
+            "fitid": tags.get("FITID", ""),
+        })
+    return {"transactions": txns, "balances": balances, "account_type": "credit-card" if credit_card else "bank",
+            "account_number": m.group(1).strip() if m else ""}
+
+
+def load_statement(path: str, account_type: str, account_number: str,
+                   header_profile: str = None, statement_date: str = None) -> Dict[str, Any]:
+    if path.lower().endswith((".qbo", ".ofx")):
+        st = read_qbo(path)
+        # An explicit --account-number wins over the ACCTID in the file
+        st["account_number"] = account_number or st["account_number"]
+        return st
+    return load_transactions(path, account_type, account_number, header_profile, statement_date)
+
+
+class Ledger:
+    """
+    SQLite ledger: one row per (account, FITID), the source files already
+    merged, and each source's closing balance as of its last posting date.
+    """
+
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS txn (
+                account TEXT NOT NULL, fitid TEXT NOT NULL, posted TEXT NOT NULL,
+                amount TEXT NOT NULL, name TEXT NOT NULL, source TEXT NOT NULL,
+                PRIMARY KEY (account, fitid)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS txn_posted ON txn (account, posted);
+            CREATE TABLE IF NOT EXISTS source (
+                path TEXT PRIMARY KEY, account TEXT NOT NULL, size INTEGER, mtime_ns INTEGER,
+                transactions INTEGER, added INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS balance (
+                account TEXT NOT NULL, source TEXT NOT NULL, asof TEXT NOT NULL, amount TEXT NOT NULL,
+                PRIMARY KEY (account, source)
+            ) WITHOUT ROWID;
+        """)
+
+    @staticmethod
+    def account_key(account_type: str, account_number: str) -> str:
+        return f"{account_type}:{account_number or lf.ACCT_ID}"
+
+    def seen(self, path: str) -> str:
+        """The account a file was merged into, if it is unchanged since; else ""."""
+        st = os.stat(path)
+        row = self.db.execute("SELECT account, size, mtime_ns FROM source WHERE path = ?",
+                              (os.path.abspath(path),)).fetchone()
+        return row[0] if row and row[1:] == (st.st_size, st.st_mtime_ns) else ""
+
+    def merge(self, account: str, txns: List[Dict[str, Any]], path: str, closing=None) -> int:
+        """
+        Adds the transactions not yet in the account's ledger and records the
+        statement's `closing` balance (if known); returns how many were new.
+        """
+        source = os.path.abspath(path)
+        rows = []
+        for t, fitid in zip(txns, lf._iter_fitids(txns)):
+            name = (t.get("desc") or "")[:32]
+            rows.append((account, fitid, f"{t['date']:%Y%m%d}", f"{t['amount']:.2f}", name, source))
+        st = os.stat(path)
+        with self.db:
+            before = self.db.total_changes
+            self.db.executemany("INSERT OR IGNORE INTO txn VALUES (?, ?, ?, ?, ?, ?)", rows)
+            added = self.db.total_changes - before
+            self.db.execute("INSERT OR REPLACE INTO source VALUES (?, ?, ?, ?, ?, ?)",
+                            (source, account, st.st_size, st.st_mtime_ns, len(rows), added))
+            self.db.execute("DELETE FROM balance WHERE source = ?", (source,))
+            if closing is not None:
+                self.db.execute("INSERT INTO balance VALUES (?, ?, ?, ?)",
+                                (account, source, max(r[2] for r in rows), f"{closing:.2f}"))
+        return added
+
+    def ledger_balance(self, account: str):
+        """
+        The latest recorded closing balance plus anything posted after it, or
+        None when no statement of the account had a balance.
+        """
+        row = self.db.execute("SELECT asof, amount FROM balance WHERE account = ? ORDER BY asof DESC LIMIT 1",
+                              (account,)).fetchone()
+        if row is None:
+            return None
+        bal = Decimal(row[1]) + sum((Decimal(a) for a, in self.db.execute(
+            "SELECT amount FROM txn WHERE account = ? AND posted > ?", (account,) + row[:1])), Decimal(0))
+        return bal if lf.EXACT_AMOUNTS else float(bal)
+
+    def accounts(self) -> List[str]:
+        return [r[0] for r in self.db.execute("SELECT DISTINCT account FROM txn ORDER BY account")]
+
+    def transactions(self, account: str) -> Iterator[Dict[str, Any]]:
+        for fitid, posted, amount, name in self.db.execute(
+                "SELECT fitid, posted, amount, name FROM txn WHERE account = ? ORDER BY posted, fitid", (account,)):
+            amt = Decimal(amount)
+            yield {"date": datetime.strptime(posted, "%Y%m%d"), "desc": name,
+                   "amount": amt if lf.EXACT_AMOUNTS else float(amt), "fitid": fitid}
+
+    def close(self):
+        self.db.close()
+
+
+def write_combined(ledger: Ledger, account: str, out_dir: str) -> Tuple[str, int]:
+    account_type, _, account_number = account.partition(":")
+    txns = list(ledger.transactions(account))
+    out_path = os.path.join(out_dir, f"combined_{account_type}_{account_number}.qbo")
+    with lf._FileWriter(out_path) as out:
+        for chunk in lf._iter_ofx(txns, lf._qbo_account(account_type, account_number),
+                                  ledger_balance=ledger.ledger_balance(account)):
+            out.write(chunk)
+    return out_path, len(txns)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("inputs", nargs="*", help="files or directories")
+    ap.add_argument("--manifest", help="text file listing inputs, one per line")
+    ap.add_argument("--ledger", default="ledger.db", help="SQLite ledger file (created if missing)")
+    ap.add_argument("-o", "--out-dir", default="qbo-out")
+    ap.add_argument("--account-type", default="bank", choices=("bank", "credit-card"),
+                    help="for CSV inputs; dumps and QBO files carry their own")
+    ap.add_argument("--account-number", default="")
+    ap.add_argument("--header-profile", help=f"header vocabulary (default {lf.HEADER_PROFILE})")
+    ap.add_argument("--statement-date", help="statement period's last day (YYYY-MM-DD), the year for m/d dates")
+    ap.add_argument("--force", action="store_true", help="re-read inputs merged before")
+    args = ap.parse_args()
+
+    inputs = collect_inputs(args.inputs, args.manifest)
+    for d in args.inputs:
+        if os.path.isdir(d):
+            for root, _, files in sorted(os.walk(d)):
+                inputs.extend(os.path.join(root, f) for f in sorted(files) if f.lower().endswith((".qbo", ".ofx")))
+
+    ledger = Ledger(args.ledger)
+    touched = set()
+    failed = 0
+    t0 = time.perf_counter()
+    print(f"{'status':<6} {'txns':>6} {'new':>6}  input")
+    for path in inputs:
+        account = "" if args.force else ledger.seen(path)
+        if account:
+            touched.add(account)
+            print(f"{'same':<6} {'':>6} {'':>6}  {path}")
+            continue
+        try:
+            st = load_statement(path, args.account_type, args.account_number,
+                                args.header_profile, args.statement_date)
+        except Exception as e:
+            failed += 1
+            print(f"{'FAIL':<6} {'':>6} {'':>6}  {path}\n{'':<6} {type(e).__name__}: {e}")
+            continue
+        if not st["transactions"]:
+            # Not recorded as merged, so the next run reads it again (e.g. with --statement-date)
+            print(f"{'skip':<6} {0:>6} {'':>6}  {path}")
+            continue
+        account = Ledger.account_key(st["account_type"], st["account_number"])
+        closing = lf._reconcile(st["transactions"], st["balances"].get("opening"),
+                                st["balances"].get("closing"))["closing"]
+        added = ledger.merge(account, st["transactions"], path, closing)
+        touched.add(account)
+        print(f"{'ok':<6} {len(st['transactions']):>6} {added:>6}  {path}")
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    for account in (sorted(touched) if inputs else ledger.accounts()):
+        out_path, n = write_combined(ledger, account, args.out_dir)
+        print(f"\n{account}: {n} transactions -> {out_path}")
+    ledger.close()
+    print(f"done in {time.perf_counter() - t0:.2f}s")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
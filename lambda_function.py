@@ -1,12 +1,16 @@
-import os, io, csv, json, re, hashlib
-from typing import Tuple, Optional, Dict, Any, List
+import os, json, re, queue, random, threading, time, codecs
+from contextlib import contextmanager
+from typing import Tuple, Optional, Dict, Any, List, Union, Iterator
 from datetime import datetime
-import uuid
-import boto3
+from decimal import Decimal, ROUND_HALF_UP
+from array import array
+from functools import lru_cache
+# boto3, csv, hashlib, uuid, gzip/zlib, resource and tracemalloc are imported where they are used,
+# so a cold start only pays for what the invocation needs (see lambda_bench.py startup)
 
 # --- Config ---
 REGION = os.environ.get("AWS_REGION", "us-east-2")
-OUTPUT_BUCKET = os.environ["OUTPUT_BUCKET"]
+OUTPUT_BUCKET = os.environ.get("OUTPUT_BUCKET", "")  # checked when an S3 output is first needed
 OUTPUT_PREFIX = os.environ.get("OUTPUT_PREFIX", "parsed/").rstrip("/") + "/"
 
 # Optional OFX/QBO metadata (defaults for bank accounts)
@@ -17,83 +21,380 @@ FI_ORG   = os.environ.get("FI_ORG",   "CHASE BANK")
 FI_FID   = os.environ.get("FI_FID",   "00000")
 INTU_BID = os.environ.get("INTU_BID", "2430")
 
-s3 = boto3.client("s3", region_name=REGION)
-tx = boto3.client("textract", region_name=REGION)
+# Emit tables as soon as their cells arrive instead of holding every block in memory
+STREAM_TABLES = os.environ.get("STREAM_TABLES", "true").lower() in ("1", "true", "yes")
+# Result pages fetched ahead of parsing (0 = fetch inline) and retries on throttling
+PREFETCH_PAGES = int(os.environ.get("PREFETCH_PAGES", "2"))
+TEXTRACT_MAX_RETRIES = int(os.environ.get("TEXTRACT_MAX_RETRIES", "5"))
+# Keep transaction amounts as exact Decimal cents instead of floats
+EXACT_AMOUNTS = os.environ.get("EXACT_AMOUNTS", "false").lower() in ("1", "true", "yes")
+# Outputs are uploaded in chunks of this size (S3 multipart parts must be >= 5 MiB);
+# OUTPUT_LOCAL_DIR writes them to local files instead of S3
+MULTIPART_CHUNK = max(5, int(os.environ.get("MULTIPART_CHUNK_MB", "8"))) * 1024 * 1024
+OUTPUT_LOCAL_DIR = os.environ.get("OUTPUT_LOCAL_DIR", "")
+# Results are remembered per Textract JobId + source ETag so repeat deliveries skip the work
+RESULT_CACHE = os.environ.get("RESULT_CACHE", "true").lower() in ("1", "true", "yes")
+RESULT_CACHE_PREFIX = os.environ.get("RESULT_CACHE_PREFIX", "cache/").rstrip("/") + "/"
+# Store the raw Textract blocks next to the CSV for replay_handler
+SAVE_BLOCKS = os.environ.get("SAVE_BLOCKS", "false").lower() in ("1", "true", "yes")
+# One structured record per invocation: emf (CloudWatch Embedded Metric Format) | json | off
+METRICS_FORMAT = os.environ.get("METRICS_FORMAT", "emf").lower()
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "TextractToQbo")
+METRICS_TRACEMALLOC = os.environ.get("METRICS_TRACEMALLOC", "false").lower() in ("1", "true", "yes")
+# FITID hash: blake2s, or md5 to keep the ids of QBO files generated before occurrence counters
+FITID_HASH = os.environ.get("FITID_HASH", "blake2s").lower()
+# Header vocabulary: a profile from _HEADER_PROFILES (an upload's "headerprofile" metadata wins),
+# and optional JSON {"profile": {"field": ["word", ...]}} adding words or whole new profiles
+HEADER_PROFILE = os.environ.get("HEADER_PROFILE", "default").lower()
+HEADER_VOCAB = os.environ.get("HEADER_VOCAB", "")
+# Skip the transaction parse for tables that do not look like transactions (summaries, fee
+# schedules, disclosures); CSV_TRANSACTION_TABLES_ONLY also leaves them out of the CSV
+CLASSIFY_TABLES = os.environ.get("CLASSIFY_TABLES", "true").lower() in ("1", "true", "yes")
+CSV_TRANSACTION_TABLES_ONLY = os.environ.get("CSV_TRANSACTION_TABLES_ONLY", "false").lower() in ("1", "true", "yes")
+# Only write the QBO when running balances reconcile with the statement's printed balances
+RECONCILE_REQUIRED = os.environ.get("RECONCILE_REQUIRED", "false").lower() in ("1", "true", "yes")
+# Jobs converted concurrently by batch_handler (they share the clients below)
+BATCH_WORKERS = max(1, int(os.environ.get("BATCH_WORKERS", "4")))
+# Two-phase mode: page_select_handler takes a text-detection job's notification and starts TABLES
+# analysis of the transaction pages only, notifying this topic (via the role) for lambda_handler;
+# upload_handler starts the same analysis for PDFs it cannot read from their text layer
+TEXTRACT_SNS_TOPIC_ARN = os.environ.get("TEXTRACT_SNS_TOPIC_ARN", "")
+TEXTRACT_ROLE_ARN = os.environ.get("TEXTRACT_ROLE_ARN", "")
+
+# boto3 clients, created on first use; assign a stand-in (e.g. lambda_function.s3 = stub) to inject one
+s3 = None
+tx = None
+_client_lock = threading.Lock()
+
+def _aws_client(name: str):
+    import boto3
+    from botocore.config import Config
+    # Each batch worker may hold a prefetch thread and an upload at once
+    return boto3.client(name, region_name=REGION,
+                        config=Config(max_pool_connections=max(10, 2 * BATCH_WORKERS)))
+
+def _s3():
+    global s3
+    if s3 is None:
+        with _client_lock:
+            if s3 is None:
+                s3 = _aws_client("s3")
+    return s3
+
+def _textract():
+    global tx
+    if tx is None:
+        with _client_lock:
+            if tx is None:
+                tx = _aws_client("textract")
+    return tx
+
+def _output_bucket() -> str:
+    if not OUTPUT_BUCKET:
+        raise RuntimeError("OUTPUT_BUCKET environment variable is not set")
+    return OUTPUT_BUCKET
 
 # ---------- Textract helpers ----------
-def _iter_pages(job_id: str):
+_THROTTLE_CODES = ("ThrottlingException", "ProvisionedThroughputExceededException",
+                   "LimitExceededException", "InternalServerError")
+
+def _get_page(client, job_id: str, token: Optional[str], api: str = "get_document_analysis"):
+    """
+    One GetDocumentAnalysis call (or `api`, e.g. get_document_text_detection),
+    retried with exponential backoff on throttling.
+    """
+    kw = {"JobId": job_id}
+    if token:
+        kw["NextToken"] = token
+    for attempt in range(TEXTRACT_MAX_RETRIES + 1):
+        try:
+            return getattr(client, api)(**kw)
+        except Exception as e:
+            code = getattr(e, "response", {}).get("Error", {}).get("Code")
+            if code not in _THROTTLE_CODES or attempt == TEXTRACT_MAX_RETRIES:
+                raise
+            delay = min(8.0, 0.25 * 2 ** attempt) * (0.5 + random.random() / 2)
+            print(f"Textract {code}, retrying in {delay:.2f}s (attempt {attempt + 1})")
+            time.sleep(delay)
+
+def _iter_pages(job_id: str, client=None, first: Optional[Dict[str, Any]] = None,
+                api: str = "get_document_analysis"):
+    """All result pages of a job; `first` is an already fetched first page."""
+    client = client or _textract()
     token = None
     while True:
-        kw = {"JobId": job_id}
-        if token:
-            kw["NextToken"] = token
-        res = tx.get_document_analysis(**kw)
+        res = first or _get_page(client, job_id, token, api)
+        first = None
         yield res
         token = res.get("NextToken")
         if not token:
             break
 
-def _block_map(blocks):
-    return {b["Id"]: b for b in blocks}
-
-def _extract_text(block, by_id):
-    parts = []
+def _prefetch_pages(job_id: str, depth: int = None, client=None, first: Optional[Dict[str, Any]] = None):
+    """
+    Same pages as _iter_pages, but a background thread fetches page N+1 while
+    the caller parses page N. At most `depth` fetched pages wait in the queue,
+    so memory stays bounded when parsing is the slower side.
+    """
+    depth = depth or PREFETCH_PAGES
+    client = client or _textract()  # resolve on the caller's thread
+    q = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _worker():
+        try:
+            for res in _iter_pages(job_id, client, first):
+                if not _put(res):
+                    return
+            _put(done)
+        except BaseException as e:
+            _put(e)
+
+    th = threading.Thread(target=_worker, name=f"textract-prefetch-{job_id}", daemon=True)
+    th.start()
+    try:
+        while True:
+            item = q.get()
+            if item is done:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        th.join(timeout=1.0)
+
+def _child_ids(block):
     for rel in block.get("Relationships", []):
-        if rel["Type"] != "CHILD":
-            continue
-        for cid in rel["Ids"]:
-            c = by_id[cid]
-            bt = c["BlockType"]
-            if bt == "WORD":
-                parts.append(c.get("Text",""))
-            elif bt == "SELECTION_ELEMENT" and c.get("SelectionStatus") == "SELECTED":
-                parts.append("[X]")
-    return " ".join(parts).strip()
+        if rel["Type"] == "CHILD":
+            yield from rel["Ids"]
 
-def _tables_from_blocks(blocks):
+class _Cell:
+    __slots__ = ("row", "col", "row_span", "col_span", "children")
+
+class _Table:
+    __slots__ = ("id", "page", "cells")
+
+class _BlockIndex:
     """
-    Yields (table_block, grid) where grid is a 2D list of strings.
-    Handles simple RowSpan/ColumnSpan by filling the span.
-    """
-    by_id = _block_map(blocks)
-    for t in (b for b in blocks if b["BlockType"] == "TABLE"):
-        cells = []
-        for rel in t.get("Relationships", []):
-            if rel["Type"] == "CHILD":
-                for cid in rel["Ids"]:
-                    cb = by_id[cid]
-                    if cb["BlockType"] == "CELL":
-                        cells.append(cb)
+    Single-pass index over Textract blocks that keeps only what table
+    extraction reads: WORD text, CELL geometry and TABLE/CELL child ids.
+    Textract's string Ids are remapped to ints so parent->child adjacency is
+    held in compact arrays instead of the original block dicts.
+    """
+    __slots__ = ("_ids", "_next", "text", "cells")
+
+    def __init__(self):
+        self._ids: Dict[str, int] = {}
+        self._next = 0
+        self.text: Dict[int, Optional[str]] = {}  # WORD text, "[X]" for selected boxes
+        self.cells: Dict[int, _Cell] = {}
+
+    def ref(self, block_id: str) -> int:
+        i = self._ids.get(block_id)
+        if i is None:
+            i = self._ids[block_id] = self._next
+            self._next += 1
+        return i
+
+    def add(self, b) -> Tuple[int, Optional[_Table]]:
+        """Indexes one block; returns its int id and a _Table record for TABLE blocks."""
+        i = self.ref(b["Id"])
+        bt = b["BlockType"]
+        if bt == "WORD":
+            self.text[i] = b.get("Text", "")
+        elif bt == "SELECTION_ELEMENT":
+            self.text[i] = "[X]" if b.get("SelectionStatus") == "SELECTED" else None
+        elif bt == "CELL":
+            c = _Cell()
+            c.row = b.get("RowIndex", 1) - 1
+            c.col = b.get("ColumnIndex", 1) - 1
+            c.row_span = max(1, b.get("RowSpan", 1))
+            c.col_span = max(1, b.get("ColumnSpan", 1))
+            c.children = array("l", map(self.ref, _child_ids(b)))
+            self.cells[i] = c
+        elif bt == "TABLE":
+            t = _Table()
+            t.id = i
+            t.page = b.get("Page", "?")
+            t.cells = array("l", map(self.ref, _child_ids(b)))
+            return i, t
+        return i, None
+
+    def grid(self, t: _Table) -> Optional[List[List[str]]]:
+        """
+        Builds the 2D grid of strings for a table, or None if it has no cells.
+        Handles simple RowSpan/ColumnSpan by filling the span.
+        """
+        cells = [self.cells[i] for i in t.cells if i in self.cells]
         if not cells:
-            continue
-        max_row = max(c.get("RowIndex",1) + c.get("RowSpan",1) - 1 for c in cells)
-        max_col = max(c.get("ColumnIndex",1) + c.get("ColumnSpan",1) - 1 for c in cells)
+            return None
+        max_row = max(c.row + c.row_span for c in cells)
+        max_col = max(c.col + c.col_span for c in cells)
         grid = [["" for _ in range(max_col)] for _ in range(max_row)]
 
+        text = self.text
         for c in cells:
-            r0 = c.get("RowIndex",1)-1
-            c0 = c.get("ColumnIndex",1)-1
-            rs = max(1, c.get("RowSpan",1))
-            cs = max(1, c.get("ColumnSpan",1))
-            text = _extract_text(c, by_id)
-            for rr in range(r0, r0+rs):
-                for cc in range(c0, c0+cs):
-                    if grid[rr][cc] == "":
-                        grid[rr][cc] = text
-        yield t, grid
+            words = (text.get(w) for w in c.children)
+            value = " ".join(w for w in words if w is not None).strip()
+            for rr in range(c.row, c.row + c.row_span):
+                row = grid[rr]
+                for cc in range(c.col, c.col + c.col_span):
+                    if row[cc] == "":
+                        row[cc] = value
+        return grid
+
+    def release(self, t: _Table):
+        """Drops the cells and words a consumed table referenced."""
+        for i in t.cells:
+            c = self.cells.pop(i, None)
+            if c is not None:
+                for w in c.children:
+                    self.text.pop(w, None)
+
+    def clear(self):
+        self._ids.clear()
+        self.text.clear()
+        self.cells.clear()
+
+def _tables_from_blocks(blocks):
+    """
+    Yields (table, grid) where grid is a 2D list of strings.
+    One linear pass indexes the blocks; tables come out in document order.
+    """
+    index = _BlockIndex()
+    tables = []
+    for b in blocks:
+        _, t = index.add(b)
+        if t is not None:
+            tables.append(t)
+    for t in tables:
+        grid = index.grid(t)
+        if grid is not None:
+            yield t, grid
+
+_TABLE_PART_TYPES = ("TABLE", "CELL", "MERGED_CELL", "TABLE_TITLE", "TABLE_FOOTER", "WORD", "SELECTION_ELEMENT")
+
+def _stream_tables(pages):
+    """
+    Streaming counterpart of _tables_from_blocks over GetDocumentAnalysis pages.
+    Yields (table, grid) as soon as every CELL of a TABLE and every
+    WORD/SELECTION_ELEMENT of those cells has arrived, then drops those blocks.
+    Textract returns blocks in document-page order, so when the first block of
+    a later page shows up, tables still waiting on references are flushed with
+    what they have and unclaimed blocks (words outside tables) are released.
+    Peak memory is one document page plus the largest table.
+    """
+    index = _BlockIndex()
+    seen = set()  # int ids of table parts that have arrived
+    missing = {}  # table id -> number of referenced blocks not yet seen
+    waiting = {}  # referenced id -> table ids waiting on it
+    tables = {}   # table id -> _Table, in arrival order
+
+    def _need(tid, i):
+        if i not in seen:
+            waiting.setdefault(i, []).append(tid)
+            missing[tid] += 1
+            return
+        c = index.cells.get(i)
+        if c is not None:
+            for w in c.children:
+                _need(tid, w)
+
+    def _emit(tid):
+        t = tables.pop(tid)
+        missing.pop(tid, None)
+        grid = index.grid(t)
+        index.release(t)
+        return t, grid
+
+    def _flush():
+        for tid in list(tables):
+            t, grid = _emit(tid)
+            if grid is not None:
+                yield t, grid
+        index.clear()
+        seen.clear()
+        waiting.clear()
+
+    page = None
+    for page_result in pages:
+        for b in page_result.get("Blocks", []):
+            bt = b["BlockType"]
+            if bt not in _TABLE_PART_TYPES:
+                continue
+            bpage = b.get("Page")
+            if bpage is not None and page is not None and bpage > page:
+                yield from _flush()
+            if bpage is not None:
+                page = bpage if page is None else max(page, bpage)
+
+            i, t = index.add(b)
+            seen.add(i)
+            ready = []
+            if t is not None:
+                tables[i] = t
+                missing[i] = 0
+                for ci in t.cells:
+                    _need(i, ci)
+                ready.append(i)
+            c = index.cells.get(i)
+            for tid in waiting.pop(i, ()):
+                if tid not in tables:
+                    continue
+                missing[tid] -= 1
+                if c is not None:
+                    for w in c.children:
+                        _need(tid, w)
+                ready.append(tid)
+            for tid in ready:
+                if tid in tables and missing[tid] == 0:
+                    t, grid = _emit(tid)
+                    if grid is not None:
+                        yield t, grid
+    yield from _flush()
 
 # ---------- Event helpers ----------
+def _job_from_record(rec: Dict[str, Any]) -> Tuple[str, Optional[dict], Optional[str]]:
+    """
+    One SNS or SQS record -> (JobId, DocumentLocation, JobTag). SQS bodies may be
+    the Textract notification itself (raw delivery) or the SNS envelope around it.
+    """
+    if rec.get("EventSource") == "aws:sns":
+        msg_raw = rec["Sns"]["Message"]
+    elif rec.get("eventSource") == "aws:sqs":
+        msg_raw = rec["body"]
+        body = json.loads(msg_raw) if isinstance(msg_raw, str) else msg_raw
+        if isinstance(body, dict) and "JobId" not in body and "Message" in body:
+            msg_raw = body["Message"]
+        else:
+            msg_raw = body
+    else:
+        raise ValueError(f"Unsupported record source: {rec.get('EventSource') or rec.get('eventSource')}")
+    msg = json.loads(msg_raw) if isinstance(msg_raw, str) else msg_raw
+    job_id = msg.get("JobId")
+    if not job_id:
+        raise ValueError("Notification message missing JobId")
+    return job_id, msg.get("DocumentLocation"), msg.get("JobTag")
+
+def _record_id(rec: Dict[str, Any]) -> str:
+    """Identifier Lambda expects in batchItemFailures (SQS messageId; SNS MessageId for logs)."""
+    return rec.get("messageId") or rec.get("Sns", {}).get("MessageId", "")
+
 def _extract_job_from_event(event: Dict[str, Any]) -> Tuple[str, Optional[dict], Optional[str]]:
-    # SNS
+    # SNS/SQS (first record; batch_handler takes all of them)
     if isinstance(event, dict) and "Records" in event:
-        rec0 = event["Records"][0]
-        if rec0.get("EventSource") == "aws:sns":
-            msg_raw = rec0["Sns"]["Message"]
-            msg = json.loads(msg_raw) if isinstance(msg_raw, str) else msg_raw
-            job_id = msg.get("JobId")
-            if not job_id:
-                raise ValueError("SNS message missing JobId")
-            return job_id, msg.get("DocumentLocation"), msg.get("JobTag")
+        return _job_from_record(event["Records"][0])
     # Direct/test
     if "JobId" in event:
         return event["JobId"], event.get("DocumentLocation"), event.get("JobTag")
@@ -112,461 +413,1461 @@ def _resolve_source_keys(doc_loc: Optional[dict], job_tag: Optional[str]) -> Tup
             src_key    = src_key    or tag.get("key")
         except Exception:
             pass
-    return src_bucket or OUTPUT_BUCKET, src_key or "incoming/unknown.pdf"
+    return src_bucket or _output_bucket(), src_key or "incoming/unknown.pdf"
 
-def _get_s3_metadata(bucket: str, key: str) -> Dict[str, str]:
+def _head_source(bucket: str, key: str) -> Tuple[Dict[str, str], str]:
     """
-    Retrieve S3 object metadata to get account type and account number.
-    Returns dict with lowercase keys.
+    One head_object call for the source document.
+    Returns (metadata with lowercase keys, ETag); ({}, "") if it can't be read.
     """
     try:
-        response = s3.head_object(Bucket=bucket, Key=key)
+        response = _s3().head_object(Bucket=bucket, Key=key)
         metadata = response.get('Metadata', {})
         # S3 metadata keys are already lowercase
         print(f"Retrieved metadata from s3://{bucket}/{key}: {metadata}")
-        return {k.lower(): v for k, v in metadata.items()}
+        return {k.lower(): v for k, v in metadata.items()}, response.get('ETag', '').strip('"')
     except Exception as e:
         print(f"Could not retrieve metadata for s3://{bucket}/{key}: {e}")
-        return {}
+        return {}, ""
+
+def _get_s3_metadata(bucket: str, key: str) -> Dict[str, str]:
+    """
+    Retrieve S3 object metadata to get account type and account number.
+    Returns dict with lowercase keys.
+    """
+    return _head_source(bucket, key)[0]
 
 # ---------- CSV + QBO ----------
-_DATE_PATTERNS = [
-    "%Y-%m-%d", "%m/%d/%Y", "%m/%d/%y", "%d-%b-%Y", "%d-%b-%y", "%Y/%m/%d",
-    "%d/%m/%Y", "%d/%m/%y"
-]
-
-def _parse_date(s: str) -> Optional[datetime]:
-    s = (s or "").strip()
-    if not s:
+# One pass over the supported layouts; the last group that matched names the family:
+#   d1 -> %Y-%m-%d / %Y/%m/%d      y2 -> %m/%d/%Y, %m/%d/%y, %d/%m/%Y, %d/%m/%y
+#   y3 -> %d-%b-%Y / %d-%b-%y      d4 -> yyyymmdd
+#   b5 -> %m/%d, %d/%m with the year taken from the statement period
+_DATE_RE = re.compile(
+    r"(?P<Y1>\d{4})(?P<s1>[-/])(?P<m1>\d{1,2})(?P=s1)(?P<d1>\d{1,2})"
+    r"|(?P<a2>\d{1,2})/(?P<b2>\d{1,2})/(?P<y2>\d{4}|\d{2})"
+    r"|(?P<d3>\d{1,2})-(?P<b3>[A-Za-z]{3})-(?P<y3>\d{4}|\d{2})"
+    r"|(?P<Y4>\d{4})(?P<m4>\d{2})(?P<d4>\d{2})"
+    r"|(?P<a5>\d{1,2})/(?P<b5>\d{1,2})"
+)
+_MONTH_ABBR = {m: i for i, m in enumerate(
+    ("jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"), 1)}
+
+def _year(y: str) -> int:
+    # strptime's %y pivot: 69-99 -> 19xx, 00-68 -> 20xx
+    v = int(y)
+    if len(y) == 2:
+        v += 1900 if v >= 69 else 2000
+    return v
+
+def _mkdate(y: int, m: int, d: int) -> Optional[datetime]:
+    try:
+        return datetime(y, m, d)
+    except ValueError:
         return None
-    # try straight formats
-    for fmt in _DATE_PATTERNS:
-        try:
-            return datetime.strptime(s, fmt)
-        except ValueError:
-            pass
-    # try compact 8-digit yyyymmdd
-    m = re.fullmatch(r"(\d{4})(\d{2})(\d{2})", s)
-    if m:
-        try:
-            return datetime(int(m.group(1)), int(m.group(2)), int(m.group(3)))
-        except ValueError:
-            return None
-    return None
 
-def _parse_amount(s: str) -> Optional[float]:
-    if s is None:
-        return None
-    txt = str(s).strip()
-    if not txt:
-        return None
+def _short_date(end: datetime, m: int, d: int) -> Optional[datetime]:
+    # A month after the period's last month belongs to the year before (December rows on a January statement)
+    return _mkdate(end.year - (m > end.month), m, d)
 
-    # Filter out obvious non-amounts
-    # Phone numbers: 10+ consecutive digits with no decimal
-    if re.match(r'^\d{10,}$', txt):
-        return None  # Likely a phone number or reference ID
+@lru_cache(maxsize=4096)
+def _date_candidates(s: str, end: Optional[datetime] = None) -> Tuple[Tuple[str, datetime], ...]:
+    """
+    Every valid (format, date) reading of a cell, in _parse_date priority order.
+    Only m/d vs d/m slash dates can have two readings. Month/day-only dates
+    ("1/2") are read only when the statement period's `end` is known and share
+    the mdy/dmy formats of full slash dates. Cached on the raw cell text
+    because statement dates repeat heavily.
+    """
+    m = _DATE_RE.fullmatch((s or "").strip())
+    if not m:
+        return ()
+    g = m.group
+    kind = m.lastgroup
+    if kind == "b5":
+        if end is None:
+            return ()
+        a, b = int(g("a5")), int(g("b5"))
+        out = [("mdy", _short_date(end, a, b)), ("dmy", _short_date(end, b, a))]
+    elif kind == "d1":
+        out = [("ymd", _mkdate(int(g("Y1")), int(g("m1")), int(g("d1"))))]
+    elif kind == "y2":
+        a, b, y = int(g("a2")), int(g("b2")), _year(g("y2"))
+        out = [("mdy", _mkdate(y, a, b)), ("dmy", _mkdate(y, b, a))]
+    elif kind == "y3":
+        mon = _MONTH_ABBR.get(g("b3").lower())
+        out = [("dby", _mkdate(_year(g("y3")), mon, int(g("d3"))) if mon else None)]
+    else:
+        out = [("yyyymmdd", _mkdate(int(g("Y4")), int(g("m4")), int(g("d4"))))]
+    return tuple((fmt, d) for fmt, d in out if d is not None)
 
-    # handle parentheses negatives and currency symbols/commas
-    neg = False
-    if txt.startswith("(") and txt.endswith(")"):
-        neg = True
-        txt = txt[1:-1]
-    txt = txt.replace("$","").replace(",","").replace("USD","").strip()
+def _parse_date(s: str, end: Optional[datetime] = None) -> Optional[datetime]:
+    c = _date_candidates(s, end)
+    return c[0][1] if c else None
 
-    # After cleanup, check if it looks like a valid amount
-    # Valid amounts: have decimal or are reasonably sized
-    try:
-        val = float(txt)
-        # Reject if too large to be a reasonable transaction (> $1 million)
-        if abs(val) > 1000000:
+class _DateParser:
+    """
+    Per-table date parser: the format of the first date it reads is locked in,
+    so an ambiguous 01/02 is read the same way as the rest of its table.
+    `end` is the statement period's last day, for month/day-only dates.
+    """
+    __slots__ = ("fmt", "end")
+
+    def __init__(self, end: Optional[datetime] = None):
+        self.fmt = None
+        self.end = end
+
+    def parse(self, s: str) -> Optional[datetime]:
+        c = _date_candidates(s, self.end)
+        if not c:
             return None
-        return -val if neg else val
-    except ValueError:
+        if self.fmt is None:
+            self.fmt = c[0][0]
+            return c[0][1]
+        for fmt, d in c:
+            if fmt == self.fmt:
+                return d
+        return c[0][1]
+
+# Statement dates in page text: "29 de febrero de 2024", "February 29, 2024" / "Feb 29 2024", "02/29/2024"
+_PERIOD_DATE_RE = re.compile(
+    r"\b(?:(?P<d1>\d{1,2})\s+de\s+(?P<b1>[a-z]+)\s+(?:de|del)\s+(?P<y1>\d{4})"
+    r"|(?P<b2>[a-z]+)\.?\s+(?P<d2>\d{1,2}),?\s+(?P<y2>\d{4})"
+    r"|(?P<a3>\d{1,2})/(?P<c3>\d{1,2})/(?P<y3>\d{4}))\b",
+    re.IGNORECASE,
+)
+# English abbreviations plus the Spanish ones that differ (first three letters of the month name)
+_MONTH_NAMES = dict(_MONTH_ABBR, ene=1, abr=4, ago=8, set=9, dic=12)
+
+def _period_date(m) -> Optional[datetime]:
+    g = m.group
+    if g("y3"):
+        a, c, y = int(g("a3")), int(g("c3")), int(g("y3"))
+        return _mkdate(y, a, c) or _mkdate(y, c, a)
+    n = "1" if g("y1") else "2"
+    mon = _MONTH_NAMES.get(g("b" + n)[:3].lower())
+    return _mkdate(int(g("y" + n)), mon, int(g("d" + n))) if mon else None
+
+class _StatementPeriod:
+    """
+    Statement period, read once per document from the first page's LINE
+    blocks: two dates on one line ("02/01/2024 02/29/2024", "January 1, 2024
+    through January 31, 2024") are the start and end, else the first date on
+    the page ("29 de febrero de 2024") is taken as the end. `end` puts the
+    year on month/day-only dates (see _short_date).
+    """
+    __slots__ = ("start", "end", "done")
+
+    def __init__(self, end: Optional[datetime] = None):
+        self.start = None
+        self.end = end
+        self.done = end is not None
+
+    def read_lines(self, lines) -> None:
+        for text in lines:
+            if self.done:
+                return
+            found = [d for d in map(_period_date, _PERIOD_DATE_RE.finditer(text)) if d]
+            if len(found) >= 2:
+                self.start, self.end = min(found), max(found)
+                self.done = True
+            elif found and self.end is None:
+                self.end = found[0]
+
+    def read_blocks(self, blocks: List[Dict[str, Any]]) -> None:
+        """Scans page 1's LINE blocks; the first block of a later page ends the scan."""
+        lines = []
+        for b in blocks:
+            if b.get("Page", 1) > 1:
+                self.read_lines(lines)
+                self.done = True
+                return
+            if b.get("BlockType") == "LINE":
+                lines.append(b.get("Text") or "")
+        self.read_lines(lines)
+
+    def tap(self, pages):
+        """Passes GetDocumentAnalysis results through, reading the period from them on the way."""
+        for page_result in pages:
+            if not self.done:
+                self.read_blocks(page_result.get("Blocks", []))
+            yield page_result
+
+# Sign, currency and CR/DR markers around a plain or comma-grouped number; no match means "not an amount"
+_AMOUNT_RE = re.compile(
+    r"\s*(?P<lp>\()?\s*(?P<sign>[-+])?\s*(?:USD)?\s*\$?\s*(?P<sign2>[-+])?\s*"
+    r"(?P<num>\d[\d,]*(?:\.\d*)?|\.\d+)"
+    r"\s*(?:USD)?\s*(?P<suffix>-|CR|DR)?\s*(?P<rp>\))?\s*",
+    re.IGNORECASE,
+)
+_CENT = Decimal("0.01")
+_MAX_AMOUNT = 1000000
+
+def _parse_amount(s: str, exact: bool = False) -> Optional[Union[float, Decimal]]:
+    """
+    Parses a statement amount cell: "$1,234.56", "(12.00)", "12.00-", "45.10 CR", "9.99 DR".
+    Parentheses, a leading/trailing minus and DR are negative; CR is positive.
+    With exact=True the value is a Decimal rounded to cents instead of a float.
+    Cells that are not amounts fail the single regex match and return None.
+    """
+    if not s or not isinstance(s, str):
+        return None
+    m = _AMOUNT_RE.fullmatch(s)
+    if m is None:
         return None
+    num = m.group("num")
+    if (m.group("lp") is None) != (m.group("rp") is None):
+        return None
+    # Phone numbers / reference ids: 10+ bare digits
+    if len(num) >= 10 and num.isdigit():
+        return None
+    if "," in num:
+        num = num.replace(",", "")
+    val = Decimal(num).quantize(_CENT, ROUND_HALF_UP) if exact else float(num)
+    # Reject if too large to be a reasonable transaction (> $1 million)
+    if val > _MAX_AMOUNT:
+        return None
+
+    neg = m.group("lp") is not None
+    for sign in (m.group("sign"), m.group("sign2")):
+        if sign == "-":
+            neg = not neg
+    suffix = m.group("suffix")
+    if suffix == "-" or (suffix and suffix.upper() == "DR"):
+        neg = True
+    elif suffix:
+        neg = False
+    return -val if neg else val
+
+# Header words per column field, matched as substrings of lowercased, accent-folded cells
+_HEADER_VOCAB: Dict[str, Dict[str, Tuple[str, ...]]] = {
+    "en": {
+        "date": ("date",),
+        "amount": ("amount", "amt"),
+        "debit": ("debit",),
+        "credit": ("credit",),
+        "desc": ("description", "desc", "payee", "memo", "name", "details"),
+        "balance": ("balance",),
+    },
+    "es": {
+        "date": ("fecha",),
+        "amount": ("importe", "monto", "cantidad"),
+        "debit": ("debito", "retiro", "cargos"),
+        "credit": ("credito", "deposito", "abono"),
+        "desc": ("descripcion", "concepto", "detalle", "beneficiario"),
+        "balance": ("saldo",),
+    },
+}
+# Only cells up to this long are header candidates (longer ones are prose: "descargar", "fecha de ...")
+_HEADER_CELL_MAX = 40
+# Profiles are the vocabularies they combine; per-bank entries pick the languages that bank prints
+_HEADER_PROFILES: Dict[str, Tuple[str, ...]] = {
+    "default": ("en", "es"),
+    "en": ("en",),
+    "es": ("es",),
+    "wellsfargo": ("es", "en"),
+}
+
+@lru_cache(maxsize=1)
+def _fold_table() -> Dict[int, str]:
+    """Latin accented letters -> their base letter, for str.translate."""
+    import unicodedata
+    return {cp: unicodedata.normalize("NFKD", chr(cp))[0] for cp in range(0xC0, 0x250)
+            if unicodedata.normalize("NFKD", chr(cp))[0] != chr(cp)}
+
+def _fold(s: str) -> str:
+    """
+    Lowercase without accents, one character per character so match offsets
+    still index the original: "Depósitos/ Créditos" -> "depositos/ creditos".
+    """
+    if s.isascii():
+        return s.lower()
+    return s.translate(_fold_table()).lower()
 
-def _detect_header_indices(grid: List[List[str]]) -> Optional[Dict[str,int]]:
+class _HeaderMatcher:
+    """
+    A profile's header words compiled into one plain alternation, longest
+    words first, so a whole row is classified by a single finditer; `fields`
+    maps each matched word back to its column field. (Named groups per field
+    read better but make the regex engine about three times slower.)
+    """
+    __slots__ = ("pattern", "fields")
+
+    def __init__(self, vocab: Dict[str, List[str]]):
+        self.fields = {w: field for field, words in vocab.items() for w in words if w}
+        self.pattern = re.compile("|".join(re.escape(w) for w in sorted(self.fields, key=len, reverse=True))
+                                  or "(?!)")
+
+@lru_cache(maxsize=None)
+def _header_matcher(profile: str = None) -> _HeaderMatcher:
+    """The matcher for a header profile (default HEADER_PROFILE); unknown profiles fall back to "default"."""
+    profile = (profile or HEADER_PROFILE).lower()
+    extra = json.loads(HEADER_VOCAB) if HEADER_VOCAB else {}
+    names = _HEADER_PROFILES.get(profile, () if profile in extra else _HEADER_PROFILES["default"]) + (profile,)
+    vocab: Dict[str, List[str]] = {}
+    for name in names:
+        for source in (_HEADER_VOCAB.get(name, {}), extra.get(name, {})):
+            for field, words in source.items():
+                vocab.setdefault(field, []).extend(_fold(w.strip()) for w in words)
+    return _HeaderMatcher(vocab)
+
+def _detect_header_indices(grid: List[List[str]], headers: _HeaderMatcher = None) -> Optional[Dict[str,int]]:
     """
     Best-effort header detection within first 5 rows.
-    Returns a mapping like {'date': i, 'desc': j, 'amount': k} if found.
-    Also supports debit/credit columns to synthesize amount.
+    Returns a mapping like {'date': i, 'desc': j, 'amount': k, 'header_row': r} if found.
+    Also supports debit/credit columns to synthesize amount, and a running
+    balance column ('balance') used for reconciliation. Each cell is classified
+    once by the `headers` matcher (default: _header_matcher() for HEADER_PROFILE);
+    cells longer than _HEADER_CELL_MAX are skipped, and date, description and
+    amount must be distinct columns.
     """
+    from bisect import bisect_right
+    headers = headers or _header_matcher()
+    words = headers.fields
     max_scan = min(len(grid), 5)
     for r in range(max_scan):
-        row = [ (c or "").strip() for c in grid[r] ]
-        lower = [ c.lower() for c in row ]
-        idx = {}
-        # date column
-        for i, c in enumerate(lower):
-            if "date" in c:
-                idx['date'] = i; break
-        # amount OR debit/credit
-        amt_i = None
-        for i, c in enumerate(lower):
-            if any(tok in c for tok in ("amount","amt")):
-                amt_i = i; break
-        debit_i = credit_i = None
-        if amt_i is None:
-            for i, c in enumerate(lower):
-                if "debit" in c: debit_i = i
-                if "credit" in c: credit_i = i
-        # description/payee/memo
-        desc_i = None
-        for i, c in enumerate(lower):
-            if any(tok in c for tok in ("description","desc","payee","memo","name","details")):
-                desc_i = i; break
-
-        if 'date' in idx and (amt_i is not None or debit_i is not None or credit_i is not None) and desc_i is not None:
-            idx['desc'] = desc_i
-            if amt_i is not None:
-                idx['amount'] = amt_i
+        # The whole row in one search: cells joined by NUL, matches mapped back to cells by offset
+        cells = [c if isinstance(c, str) and len(c) <= _HEADER_CELL_MAX else "" for c in grid[r]]
+        starts, pos = [], 0
+        for c in cells:
+            starts.append(pos)
+            pos += len(c) + 1
+        found: Dict[str, int] = {}
+        for m in headers.pattern.finditer(_fold("\0".join(cells))):
+            f, i = words[m.group()], bisect_right(starts, m.start()) - 1
+            # debit/credit keep the last matching column, everything else the first
+            if f in ('debit', 'credit') or f not in found:
+                found[f] = i
+
+        if 'date' in found and 'desc' in found and ({'amount', 'debit', 'credit'} & found.keys()):
+            idx = {'date': found['date'], 'desc': found['desc']}
+            if 'amount' in found:
+                idx['amount'] = found['amount']
             else:
-                if debit_i is not None: idx['debit'] = debit_i
-                if credit_i is not None: idx['credit'] = credit_i
-            # assume next row is data start; caller should skip header row
+                for f in ('debit', 'credit'):
+                    if f in found:
+                        idx[f] = found[f]
+            if len(set(idx.values())) < len(idx):
+                continue
+            if 'balance' in found and found['balance'] not in idx.values():
+                idx['balance'] = found['balance']
+            # data starts on the row after the header
+            idx['header_row'] = r
             return idx
     return None
 
-def _rows_to_transactions(grid: List[List[str]]) -> List[Dict[str,Any]]:
+def _column(rows: List[List[str]], i: Optional[int]) -> List[str]:
+    if i is None:
+        return [""] * len(rows)
+    return [(r[i] if i < len(r) and isinstance(r[i], str) else "") for r in rows]
+
+def _profile_columns(grid: List[List[str]], end: Optional[datetime] = None) -> Optional[Dict[str,int]]:
+    """
+    Picks date/desc/amount columns for a grid without a recognizable header by
+    scoring whole columns: the date column is the one with the most parseable
+    dates, amounts are columns whose non-empty cells on date rows are nearly all
+    amounts, and the description is the text column holding the most text.
+    Two neighbouring amount columns that are rarely filled on the same row but
+    together cover the table are read as credit/debit, the order Wells Fargo
+    prints them in; otherwise the leftmost fully populated amount column wins,
+    so a trailing running balance is not picked; the rightmost amount column
+    after the chosen ones is taken as that balance. A lone amount column gets
+    its sign from _amount_role. `end` is the statement period's last day, so
+    month/day-only dates count as dates.
+    """
+    ncols = max((len(r) for r in grid), default=0)
+    if ncols < 2:
+        return None
+    cols = [_column(grid, i) for i in range(ncols)]
+    is_date = [[bool(_date_candidates(v, end)) for v in col] for col in cols]
+    date_counts = [sum(flags) for flags in is_date]
+    date_i = max(range(ncols), key=date_counts.__getitem__)
+    if date_counts[date_i] == 0:
+        return None
+    date_rows = [r for r, ok in enumerate(is_date[date_i]) if ok]
+
+    n = len(date_rows)
+    amount_cols, filled_rows, text_len = [], {}, {}
+    for c in range(ncols):
+        if c == date_i:
+            continue
+        cells = [cols[c][r].strip() for r in date_rows]
+        filled = {r for r, v in enumerate(cells) if v}
+        if not filled:
+            continue
+        amounts = sum(_parse_amount(cells[r]) is not None for r in filled)
+        if amounts and amounts >= 0.9 * len(filled):
+            amount_cols.append(c)
+            filled_rows[c] = filled
+        else:
+            text_len[c] = sum(len(cells[r]) for r in filled if not _date_candidates(cells[r], end))
+
+    idx = {'date': date_i}
+    for a, b in zip(amount_cols, amount_cols[1:]):
+        fa, fb = filled_rows[a], filled_rows[b]
+        if len(fa & fb) <= 0.1 * n and len(fa | fb) >= 0.8 * n:
+            idx['credit'], idx['debit'] = a, b
+            break
+    else:
+        full = [c for c in amount_cols if len(filled_rows[c]) >= 0.8 * n]
+        if not (full or amount_cols):
+            return None
+        amt = (full or amount_cols)[0]
+        tail = [c for c in amount_cols if c > amt]
+        role = _amount_role(cols, date_rows, amt, tail[-1] if tail else None)
+        if role is None:
+            return None
+        idx[role] = amt
+    tail = [c for c in amount_cols if c > max(v for k, v in idx.items() if k != 'date')]
+    if tail:
+        idx['balance'] = tail[-1]
+    if text_len:
+        idx['desc'] = max(text_len, key=text_len.__getitem__)
+    return idx
+
+def _amount_role(cols: List[List[str]], rows: List[int], a: int, b: Optional[int]) -> Optional[str]:
+    """
+    How a lone amount column `a` is signed, for a table where only one of the
+    credit/debit columns has values (a page of withdrawals alone): 'amount'
+    when the running balance `b` moves by the amounts as printed, 'debit' when
+    it moves by their negation. Without a balance to tell, only a column that
+    prints its own minus signs is an 'amount'; else None, rather than book
+    unsigned withdrawals as deposits.
+    """
+    vals = {r: _parse_amount(cols[a][r]) for r in rows}
+    if b is not None:
+        votes = {'amount': 0, 'debit': 0}
+        prev, run = None, 0
+        for r in rows:
+            run += _cents(vals[r] or 0)
+            bal = _parse_amount(cols[b][r])
+            if bal is None:
+                continue
+            if prev is not None and run:
+                delta = _cents(bal) - prev
+                if delta == run:
+                    votes['amount'] += 1
+                elif delta == -run:
+                    votes['debit'] += 1
+            prev, run = _cents(bal), 0
+        if any(votes.values()):
+            return max(votes, key=votes.__getitem__)
+    return 'amount' if any(v is not None and v < 0 for v in vals.values()) else None
+
+# Anything shaped like a date, including the month/day-only "1/2" that needs a statement year
+_DATELIKE_RE = re.compile(r"\d{1,4}[-/]\d{1,2}(?:[-/]\d{2,4})?|\d{1,2}\.\d{1,2}\.\d{2,4}"
+                          r"|\d{1,2}[- ][A-Za-z]{3}(?:[- ]\d{2,4})?")
+
+def _is_transaction_table(grid: List[List[str]], sample: int = 8, headers: _HeaderMatcher = None) -> bool:
+    """
+    Cheap pre-check before _rows_to_transactions: at least a third of up to
+    `sample` rows (spread over the table) with a date-like cell in the first
+    three columns and an amount after it, or else a recognizable header.
+    Summaries, fee schedules and boilerplate fail it without any column being
+    parsed in full.
+    """
+    if max((len(r) for r in grid), default=0) < 2:
+        return False
+    hits = seen = 0
+    for row in grid[::max(1, len(grid) // sample)]:
+        cells = [c.strip() if isinstance(c, str) else "" for c in row]
+        if not any(cells):
+            continue
+        seen += 1
+        lead = next((i for i, c in enumerate(cells[:3]) if c and _DATELIKE_RE.fullmatch(c)), None)
+        if lead is not None and any(_parse_amount(c) is not None for c in cells[lead + 1:] if 0 < len(c) < 20):
+            hits += 1
+        if seen == sample:
+            break
+    return (seen > 0 and hits * 3 >= seen) or _detect_header_indices(grid, headers) is not None
+
+class _TableSchema:
+    """
+    Column layout carried across the tables of one document. Statements split
+    one transaction table into a TABLE per page and only the first has a
+    header, so continuation tables with the same shape reuse its indices.
+    `headers` is the document's header matcher (see _header_matcher) and
+    `period` its _StatementPeriod.
+    """
+    __slots__ = ("ncols", "indices", "headers", "period")
+
+    def __init__(self, profile: str = None, period: _StatementPeriod = None):
+        self.ncols = None
+        self.indices = None
+        self.headers = _header_matcher(profile)
+        self.period = period or _StatementPeriod()
+
+    def matches(self, grid: List[List[str]], sample: int = 10) -> bool:
+        """Same column count, and the carried date column holds dates on most sampled rows."""
+        if self.indices is None or max((len(r) for r in grid), default=0) != self.ncols:
+            return False
+        d = self.indices['date']
+        rows = [r for r in grid if any(isinstance(c, str) and c.strip() for c in r)][:sample]
+        hits = sum(bool(_date_candidates(v, self.period.end)) for v in _column(rows, d))
+        return bool(rows) and hits * 2 >= len(rows)
+
+    def remember(self, grid: List[List[str]], indices: Dict[str,int]):
+        self.ncols = max((len(r) for r in grid), default=0)
+        self.indices = dict(indices)
+
+def _rows_to_transactions(grid: List[List[str]], schema: Optional[_TableSchema] = None) -> List[Dict[str,Any]]:
     """
     Convert a table grid to transaction dicts.
-    Returns list of {date: datetime, desc: str, amount: float}
+    Returns list of {date: datetime, desc: str, amount: float}, plus
+    balance: float on rows that print a running balance.
+    Columns are chosen once per table (header row, else the layout carried in
+    `schema` from an earlier table of the same shape, else _profile_columns)
+    and each column is then parsed in one batch; month/day-only dates take
+    their year from the schema's statement period.
     """
     txns = []
     if not grid:
         return txns
 
-    indices = _detect_header_indices(grid)
-    start_row = 1 if indices else 0  # if we found a header, treat row 0 as header
-
-    for r in range(start_row, len(grid)):
-        row = grid[r]
-        # skip empty-ish rows
-        if not any(cell.strip() for cell in row if isinstance(cell, str)):
-            continue
+    end = schema.period.end if schema is not None else None
+    indices = _detect_header_indices(grid, schema.headers if schema is not None else None)
+    if indices:
+        start_row = indices.pop('header_row') + 1
+    else:
+        start_row = 0
+        if schema is not None and schema.matches(grid):
+            indices = dict(schema.indices)
+        else:
+            indices = _profile_columns(grid, end)
+        if not indices:
+            return txns
+    if schema is not None:
+        schema.remember(grid, indices)
+
+    # skip empty-ish rows
+    rows = [row for row in grid[start_row:]
+            if any(cell.strip() for cell in row if isinstance(cell, str))]
+
+    dates = _DateParser(end)
+    date_vals = [dates.parse(v) for v in _column(rows, indices.get('date'))]
+    desc_vals = [v.strip() for v in _column(rows, indices.get('desc'))]
+    if 'amount' in indices:
+        amt_vals = [_parse_amount(v, EXACT_AMOUNTS) for v in _column(rows, indices['amount'])]
+    else:
+        debits = [_parse_amount(v, EXACT_AMOUNTS) for v in _column(rows, indices.get('debit'))]
+        credits = [_parse_amount(v, EXACT_AMOUNTS) for v in _column(rows, indices.get('credit'))]
+        amt_vals = [-abs(d) if d is not None else (abs(c) if c is not None else None)
+                    for d, c in zip(debits, credits)]
+    if 'balance' in indices:
+        bal_vals = [_parse_amount(v, EXACT_AMOUNTS) for v in _column(rows, indices['balance'])]
+    else:
+        bal_vals = [None] * len(rows)
 
-        # try parse by indices
-        date_val = desc_val = amt_val = None
-        if indices:
-            d_idx = indices.get('date')
-            desc_idx = indices.get('desc')
-            a_idx = indices.get('amount')
-            deb_i = indices.get('debit')
-            cre_i = indices.get('credit')
+    for date_val, desc_val, amt_val, bal_val in zip(date_vals, desc_vals, amt_vals, bal_vals):
+        # require minimally date + amount (desc may be empty)
+        if date_val and (amt_val is not None):
+            t = {
+                "date": date_val,
+                "desc": desc_val[:32],
+                "amount": amt_val if EXACT_AMOUNTS else float(amt_val)
+            }
+            if bal_val is not None:
+                t["balance"] = bal_val
+            txns.append(t)
+    return txns
 
-            d_txt = row[d_idx] if d_idx is not None and d_idx < len(row) else ""
-            date_val = _parse_date(d_txt)
+def _make_fitid(d: datetime, desc: str, amt: float, occurrence: int = 1) -> str:
+    """
+    Stable id for a transaction's date, amount and name. The nth identical
+    transaction in a statement passes occurrence=n, so repeats such as two
+    same-day ATM fees keep distinct FITIDs (QuickBooks drops duplicates).
+    """
+    import hashlib
+    key = f"{d.year:04d}{d.month:02d}{d.day:02d}{amt:.2f}{desc}"
+    if occurrence > 1:
+        key += f"#{occurrence}"
+    if FITID_HASH == "md5":
+        return hashlib.md5(key.encode("utf-8")).hexdigest()[:12]
+    return hashlib.blake2s(key.encode("utf-8"), digest_size=8).hexdigest()
+
+def _iter_fitids(transactions, name_len: int = 32) -> Iterator[str]:
+    """FITIDs for a statement's transactions in order, numbering identical repeats."""
+    occurrences: Dict[Tuple[Any, str, Any], int] = {}
+    for t in transactions:
+        if t.get("fitid"):
+            yield t["fitid"]
+            continue
+        name = (t.get("desc") or "")[:name_len]
+        k = (t["date"], name, t["amount"])
+        n = occurrences[k] = occurrences.get(k, 0) + 1
+        yield _make_fitid(t["date"], name, t["amount"], n)
+
+_OFX_HEADER = "".join(line + "\r\n" for line in (
+    "OFXHEADER:100",
+    "DATA:OFXSGML",
+    "VERSION:102",
+    "SECURITY:NONE",
+    "ENCODING:USASCII",
+    "CHARSET:1252",
+    "COMPRESSION:NONE",
+    "OLDFILEUID:NONE",
+    "NEWFILEUID:NONE",
+    ""  # blank line before <OFX>
+))
+
+class _BankStatement:
+    """
+    OFX account strategy for BANK accounts: BANKMSGSRSV1, STMTTRNRS, STMTRS
+    and BANKACCTFROM; amounts are written with their parsed sign.
+    """
+    msgs, trnrs, stmtrs = "BANKMSGSRSV1", "STMTTRNRS", "STMTRS"
+    default_org = "BANK"
 
-            desc_val = (row[desc_idx] if desc_idx is not None and desc_idx < len(row) else "").strip()
+    def __init__(self, acctid: str, bankid: str = None, accttype: str = None):
+        self.acctid = acctid
+        self.bankid = bankid or BANK_ID
+        self.accttype = accttype or ACCT_TYPE
 
-            if a_idx is not None and a_idx < len(row):
-                amt_val = _parse_amount(row[a_idx])
-            else:
-                debit_val = _parse_amount(row[deb_i]) if deb_i is not None and deb_i < len(row) else None
-                credit_val = _parse_amount(row[cre_i]) if cre_i is not None and cre_i < len(row) else None
+    def acct_from(self) -> str:
+        return (f"<BANKACCTFROM><BANKID>{self.bankid}</BANKID><ACCTID>{self.acctid}</ACCTID>"
+                f"<ACCTTYPE>{self.accttype}</ACCTTYPE></BANKACCTFROM>")
 
-                # Debug: log what we found
-                if debit_val is not None or credit_val is not None:
-                    print(f"    Row parse: debit={debit_val}, credit={credit_val}, debit_col={row[deb_i] if deb_i is not None and deb_i < len(row) else 'N/A'}, credit_col={row[cre_i] if cre_i is not None and cre_i < len(row) else 'N/A'}")
+    def entry(self, amount) -> Tuple[str, str]:
+        """(TRNTYPE, TRNAMT) for a parsed amount."""
+        return ("CREDIT" if amount > 0 else "DEBIT"), f"{amount:.2f}"
 
-                if debit_val is not None:
-                    amt_val = -abs(debit_val)
-                elif credit_val is not None:
-                    amt_val = abs(credit_val)
-        else:
-            # No header detected - try intelligent column detection
-            # Common patterns: [date, desc, ..., amount] or [date, desc, city, state, foreign, amount]
-            # Look for date in first column and amount in last few columns
-            if len(row) >= 2:
-                # Try first column as date
-                date_val = _parse_date(row[0])
-
-                if date_val:
-                    # Found a date, now find amount (usually in last 1-3 columns)
-                    # and description (usually column 1 or 2)
-                    for i in range(len(row) - 1, max(0, len(row) - 4), -1):
-                        amt_val = _parse_amount(row[i])
-                        if amt_val is not None:
-                            # Found amount, description is likely column 1
-                            desc_val = (row[1] if len(row) > 1 else "").strip()
-                            break
+class _CreditCardStatement(_BankStatement):
+    """
+    OFX account strategy for CREDIT CARD accounts: CREDITCARDMSGSRSV1,
+    CCSTMTTRNRS, CCSTMTRS and CCACCTFROM (ACCTID only, no BANKID/ACCTTYPE).
+    Positive amounts from the PDF are charges (DEBIT, negative TRNAMT);
+    negative amounts are payments/credits (CREDIT, positive TRNAMT).
+    """
+    msgs, trnrs, stmtrs = "CREDITCARDMSGSRSV1", "CCSTMTTRNRS", "CCSTMTRS"
+    default_org = "AMEX"
 
-        # require minimally date + amount (desc may be empty)
-        if date_val and (amt_val is not None):
-            txns.append({
-                "date": date_val,
-                "desc": (desc_val or "")[:32],
-                "amount": float(amt_val)
-            })
-    return txns
+    def acct_from(self) -> str:
+        return f"<CCACCTFROM><ACCTID>{self.acctid}</ACCTID></CCACCTFROM>"
 
-def _make_fitid(d: datetime, desc: str, amt: float) -> str:
-    # 12-hex unique id from simple hash
-    h = hashlib.md5(f"{d:%Y%m%d}{amt:.2f}{desc}".encode("utf-8")).hexdigest()
-    return h[:12]
+    def entry(self, amount) -> Tuple[str, str]:
+        if amount > 0:
+            return "DEBIT", f"-{amount:.2f}"
+        return "CREDIT", f"{abs(amount):.2f}"
 
-def _build_bank_qbo(transactions, account_number=""):
+def _iter_ofx(transactions, account: _BankStatement, fi_org: str = None, fi_fid: str = None,
+              intu_bid: str = None, name_len: int = 32, ledger_balance=None) -> Iterator[bytes]:
     """
-    Build a QBO (OFX 1.02) for BANK accounts acceptable to QuickBooks Desktop.
-    Uses BANKMSGSRSV1, STMTTRNRS, STMTRS, BANKACCTFROM tags.
+    Serializes a QBO (OFX 1.02) document acceptable to QuickBooks Desktop as
+    byte chunks: the header and statement opening, one chunk per STMTTRN, then
+    the closing balances. DTSTART/DTEND and the ending balance (the statement's
+    `ledger_balance`, else the sum of amounts) come from a single pass over
+    `transactions` before writing.
+    A transaction's "fitid", when present, is used instead of _iter_fitids.
     """
-    fi_org = FI_ORG or "BANK"
-    fi_fid = FI_FID or "3000"
-    intu_bid = INTU_BID or "2430"
-    bankid = BANK_ID
-    acctid = account_number or ACCT_ID
-    accttype = ACCT_TYPE
-
-    def _crlf_join(lines):
-        return "\r\n".join(lines) + "\r\n"
-
-    header = _crlf_join([
-        "OFXHEADER:100",
-        "DATA:OFXSGML",
-        "VERSION:102",
-        "SECURITY:NONE",
-        "ENCODING:USASCII",
-        "CHARSET:1252",
-        "COMPRESSION:NONE",
-        "OLDFILEUID:NONE",
-        "NEWFILEUID:NONE",
-        ""  # blank line before <OFX>
-    ])
+    fi_org = fi_org or FI_ORG or account.default_org
+    fi_fid = fi_fid or FI_FID or "3000"
+    intu_bid = intu_bid or INTU_BID or "2430"
 
+    import uuid
     now = datetime.utcnow()
     dtserver = now.strftime("%Y%m%d%H%M%S")
     trnuid = uuid.uuid4().hex[:16]  # TRNUID must be present; any unique string
 
-    # Dates for BANKTRANLIST
-    if transactions:
-        dates = sorted(t["date"] for t in transactions)
-        dtstart = dates[0].strftime("%Y%m%d")
-        dtend   = dates[-1].strftime("%Y%m%d")
-    else:
-        dtstart = now.strftime("%Y%m%d")
-        dtend   = now.strftime("%Y%m%d")
-
-    # Compute a simple ending balance (sum of amounts); if you have a real starting balance, use it.
-    ending_balance = sum(t["amount"] for t in transactions) if transactions else 0.0
+    first = last = None
+    ending_balance = 0
+    for t in transactions:
+        d = t["date"]
+        if first is None or d < first:
+            first = d
+        if last is None or d > last:
+            last = d
+        ending_balance += t["amount"]
+    if ledger_balance is not None:
+        ending_balance = ledger_balance
+    dtstart = (first or now).strftime("%Y%m%d")
+    dtend = (last or now).strftime("%Y%m%d")
     dtasof = dtend + "120000"  # include time for balance timestamps
 
-    lines = []
-    lines.append("<OFX>")
-    # Sign-on
-    lines += [
+    yield (_OFX_HEADER + "\r\n".join((
+        "<OFX>",
         "<SIGNONMSGSRSV1><SONRS>",
         "<STATUS><CODE>0</CODE><SEVERITY>INFO</SEVERITY></STATUS>",
         f"<DTSERVER>{dtserver}</DTSERVER>",
         "<LANGUAGE>ENG</LANGUAGE>",
         f"<FI><ORG>{fi_org}</ORG><FID>{fi_fid}</FID></FI>",
         f"<INTU.BID>{intu_bid}</INTU.BID>",
-        "</SONRS></SIGNONMSGSRSV1>"
-    ]
-    # Banking message with TRNUID - BANK format
-    lines += [
-        "<BANKMSGSRSV1><STMTTRNRS>",
+        "</SONRS></SIGNONMSGSRSV1>",
+        f"<{account.msgs}><{account.trnrs}>",
         f"<TRNUID>{trnuid}</TRNUID>",
         "<STATUS><CODE>0</CODE><SEVERITY>INFO</SEVERITY></STATUS>",
-        "<STMTRS>",
+        f"<{account.stmtrs}>",
         "<CURDEF>USD</CURDEF>",
-        f"<BANKACCTFROM><BANKID>{bankid}</BANKID><ACCTID>{acctid}</ACCTID><ACCTTYPE>{accttype}</ACCTTYPE></BANKACCTFROM>",
-        f"<BANKTRANLIST><DTSTART>{dtstart}</DTSTART><DTEND>{dtend}</DTEND>"
-    ]
-
-    # Transactions
-    for t in transactions:
-        trntype = "CREDIT" if t["amount"] > 0 else "DEBIT"
-        dt = t["date"].strftime("%Y%m%d")
-        amt = f"{t['amount']:.2f}"
-        name = (t.get("desc") or "")[:32]
-        fitid = _make_fitid(t["date"], name, t["amount"])
-        lines += [
-            "<STMTTRN>",
-            f"<TRNTYPE>{trntype}</TRNTYPE>",
-            f"<DTPOSTED>{dt}</DTPOSTED>",
-            f"<TRNAMT>{amt}</TRNAMT>",
-            f"<FITID>{fitid}</FITID>",
-            f"<NAME>{name}</NAME>",
-            "</STMTTRN>"
-        ]
-
-    # Close list + add balances
-    lines += [
+        account.acct_from(),
+        f"<BANKTRANLIST><DTSTART>{dtstart}</DTSTART><DTEND>{dtend}</DTEND>",
+    )) + "\r\n").encode("utf-8")
+
+    for t, fitid in zip(transactions, _iter_fitids(transactions, name_len)):
+        trntype, amt = account.entry(t["amount"])
+        name = (t.get("desc") or "")[:name_len]
+        yield (f"<STMTTRN>\r\n<TRNTYPE>{trntype}</TRNTYPE>\r\n<DTPOSTED>{t['date']:%Y%m%d}</DTPOSTED>\r\n"
+               f"<TRNAMT>{amt}</TRNAMT>\r\n<FITID>{fitid}</FITID>\r\n<NAME>{name}</NAME>\r\n</STMTTRN>\r\n"
+               ).encode("utf-8")
+
+    yield ("\r\n".join((
         "</BANKTRANLIST>",
         f"<LEDGERBAL><BALAMT>{ending_balance:.2f}</BALAMT><DTASOF>{dtasof}</DTASOF></LEDGERBAL>",
         f"<AVAILBAL><BALAMT>{ending_balance:.2f}</BALAMT><DTASOF>{dtasof}</DTASOF></AVAILBAL>",
-        "</STMTRS></STMTTRNRS></BANKMSGSRSV1>",
-    ]
-    lines.append("</OFX>")
+        f"</{account.stmtrs}></{account.trnrs}></{account.msgs}>",
+        "</OFX>",
+    )) + "\r\n").encode("utf-8")
 
-    return header + _crlf_join(lines)
+def _qbo_account(account_type: str, account_number: str = "") -> _BankStatement:
+    """OFX account strategy for an upload's accounttype metadata ('bank' or 'credit-card')."""
+    if account_type == 'credit-card':
+        return _CreditCardStatement(account_number or ACCT_ID)
+    return _BankStatement(account_number or ACCT_ID)
+
+def _build_bank_qbo(transactions, account_number=""):
+    """
+    Build a QBO (OFX 1.02) for BANK accounts acceptable to QuickBooks Desktop.
+    Uses BANKMSGSRSV1, STMTTRNRS, STMTRS, BANKACCTFROM tags.
+    """
+    return b"".join(_iter_ofx(transactions, _qbo_account('bank', account_number))).decode("utf-8")
 
 def _build_creditcard_qbo(transactions, account_number=""):
     """
     Build a QBO (OFX 1.02) for CREDIT CARD accounts acceptable to QuickBooks Desktop.
     Uses CREDITCARDMSGSRSV1, CCSTMTTRNRS, CCSTMTRS, CCACCTFROM tags.
-    Removes BANKID, ACCTTYPE - uses only ACCTID in CCACCTFROM.
-    """
-    fi_org = FI_ORG or "AMEX"
-    fi_fid = FI_FID or "3000"
-    intu_bid = INTU_BID or "2430"
-    acctid = account_number or ACCT_ID
-
-    def _crlf_join(lines):
-        return "\r\n".join(lines) + "\r\n"
-
-    header = _crlf_join([
-        "OFXHEADER:100",
-        "DATA:OFXSGML",
-        "VERSION:102",
-        "SECURITY:NONE",
-        "ENCODING:USASCII",
-        "CHARSET:1252",
-        "COMPRESSION:NONE",
-        "OLDFILEUID:NONE",
-        "NEWFILEUID:NONE",
-        ""  # blank line before <OFX>
-    ])
+    """
+    return b"".join(_iter_ofx(transactions, _qbo_account('credit-card', account_number))).decode("utf-8")
 
-    now = datetime.utcnow()
-    dtserver = now.strftime("%Y%m%d%H%M%S")
-    trnuid = uuid.uuid4().hex[:16]
+# ---------- Reconciliation ----------
+# Summary rows such as "Saldo inicial al 2/1 | $49.06" or "Ending balance on 2/29 | $55.33"
+_OPENING_RE = re.compile(r"\b(?:saldo inicial|opening balance|beginning balance|previous balance|balance forward)",
+                         re.I)
+_CLOSING_RE = re.compile(r"\b(?:saldo final|ending balance|closing balance|new balance)", re.I)
 
-    # Dates for BANKTRANLIST (credit cards use same transaction list structure)
-    if transactions:
-        dates = sorted(t["date"] for t in transactions)
-        dtstart = dates[0].strftime("%Y%m%d")
-        dtend   = dates[-1].strftime("%Y%m%d")
-    else:
-        dtstart = now.strftime("%Y%m%d")
-        dtend   = now.strftime("%Y%m%d")
-
-    # For credit cards, balance is typically negative (what you owe)
-    # Sum charges (negative) and payments (positive)
-    ending_balance = sum(t["amount"] for t in transactions) if transactions else 0.0
-    dtasof = dtend + "120000"
-
-    lines = []
-    lines.append("<OFX>")
-    # Sign-on
-    lines += [
-        "<SIGNONMSGSRSV1><SONRS>",
-        "<STATUS><CODE>0</CODE><SEVERITY>INFO</SEVERITY></STATUS>",
-        f"<DTSERVER>{dtserver}</DTSERVER>",
-        "<LANGUAGE>ENG</LANGUAGE>",
-        f"<FI><ORG>{fi_org}</ORG><FID>{fi_fid}</FID></FI>",
-        f"<INTU.BID>{intu_bid}</INTU.BID>",
-        "</SONRS></SIGNONMSGSRSV1>"
-    ]
-    # Credit Card message - uses CREDITCARDMSGSRSV1 and CCSTMTTRNRS
-    lines += [
-        "<CREDITCARDMSGSRSV1><CCSTMTTRNRS>",
-        f"<TRNUID>{trnuid}</TRNUID>",
-        "<STATUS><CODE>0</CODE><SEVERITY>INFO</SEVERITY></STATUS>",
-        "<CCSTMTRS>",
-        "<CURDEF>USD</CURDEF>",
-        f"<CCACCTFROM><ACCTID>{acctid}</ACCTID></CCACCTFROM>",
-        f"<BANKTRANLIST><DTSTART>{dtstart}</DTSTART><DTEND>{dtend}</DTEND>"
-    ]
+def _statement_balances(grid: List[List[str]], found: Dict[str, Any]):
+    """
+    Records the first opening and closing balance printed in a summary grid
+    (a label cell followed by an amount on the same row) into `found`.
+    Only small key/value-shaped grids are looked at.
+    """
+    if len(grid) > 20 or max((len(r) for r in grid), default=0) > 4:
+        return
+    for row in grid:
+        for i, cell in enumerate(row[:-1]):
+            if not isinstance(cell, str) or len(cell) > 80:
+                continue
+            key = "opening" if _OPENING_RE.search(cell) else "closing" if _CLOSING_RE.search(cell) else None
+            if key is None:
+                continue
+            for v in row[i + 1:]:
+                amt = _parse_amount(v.strip(), EXACT_AMOUNTS) if isinstance(v, str) else None
+                if amt is not None:
+                    found.setdefault(key, amt)
+                    break
+            break
 
-    # Transactions - for credit cards:
-    # Positive amounts from PDF = charges (DEBIT in QBO with negative amount)
-    # Negative amounts from PDF = payments/credits (CREDIT in QBO with positive amount)
-    for t in transactions:
-        # For credit cards, invert the amount sign
-        # Charges ($100) become DEBIT with amount -$100
-        # Payments (-$50) become CREDIT with amount +$50
-        if t["amount"] > 0:
-            trntype = "DEBIT"
-            amt = f"-{t['amount']:.2f}"  # Charges are negative
+def _cents(x) -> int:
+    return int(round(x * 100))
+
+def _reconcile(transactions: List[Dict[str, Any]], opening=None, closing=None) -> Dict[str, Any]:
+    """
+    Checks the parsed amounts against the statement's balances. A running sum
+    in cents from the opening balance (inferred from the first printed running
+    balance when the summary has none) must meet every row's printed balance
+    and the closing balance. Each mismatch is reported as a gap and the sum
+    re-anchored to the printed value, so one missed row is one gap.
+    "closing" is the printed closing balance, else the computed one.
+    """
+    from itertools import accumulate
+    sums = list(accumulate(_cents(t["amount"]) for t in transactions))
+    checks = [(i, _cents(t["balance"])) for i, t in enumerate(transactions) if "balance" in t]
+    report: Dict[str, Any] = {"reconciled": False, "opening": None, "closing": None,
+                              "checked": 0, "gaps": []}
+    if opening is not None:
+        base = _cents(opening)
+    elif checks:
+        i, bal = checks[0]
+        base = bal - sums[i]
+    else:
+        if closing is not None:
+            report["closing"] = float(closing)
+        return report
+
+    report["opening"] = base / 100
+    gaps = report["gaps"]
+    for i, bal in checks:
+        computed = base + sums[i]
+        if computed != bal:
+            gaps.append({"row": i, "date": f"{transactions[i]['date']:%Y-%m-%d}",
+                         "printed": bal / 100, "computed": computed / 100, "diff": (bal - computed) / 100})
+            base += bal - computed
+    end = base + (sums[-1] if sums else 0)
+    if closing is not None and _cents(closing) != end:
+        gaps.append({"row": "closing", "printed": float(closing), "computed": end / 100,
+                     "diff": (_cents(closing) - end) / 100})
+    report["closing"] = float(closing) if closing is not None else end / 100
+    report["checked"] = len(checks) + (closing is not None)
+    report["reconciled"] = report["checked"] > 0 and not gaps
+    return report
+
+# ---------- Output writers ----------
+class _OutputWriter:
+    """
+    Text sink that encodes incrementally and hands fixed-size byte chunks to
+    _write_part, so memory for an output file stays at one chunk whatever its
+    size. Use as a context manager: a clean exit finishes the file, an
+    exception aborts it.
+    """
+    location = ""
+    # When set, a clean exit hands close() to defer(close) and keeps its future in `pending`
+    defer = None
+    pending = None
+
+    def __init__(self, encoding: str = "utf-8", chunk_size: int = None):
+        self._enc = codecs.getincrementalencoder(encoding)()
+        self._buf = bytearray()
+        self._chunk = chunk_size or MULTIPART_CHUNK
+        self.bytes_written = 0
+
+    def write(self, text: Union[str, bytes]) -> int:
+        """Accepts text, encoded incrementally, or bytes that are already encoded."""
+        self._buf += text if isinstance(text, bytes) else self._enc.encode(text)
+        while len(self._buf) >= self._chunk:
+            part = bytes(self._buf[:self._chunk])
+            del self._buf[:self._chunk]
+            self._write_part(part)
+            self.bytes_written += len(part)
+        return len(text)
+
+    def close(self):
+        self._buf += self._enc.encode("", final=True)
+        tail = bytes(self._buf)
+        self._buf.clear()
+        self._finish(tail)
+        self.bytes_written += len(tail)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()
+        elif self.defer is not None:
+            self.pending = self.defer(self.close)
         else:
-            trntype = "CREDIT"
-            amt = f"{abs(t['amount']):.2f}"  # Payments are positive
-
-        dt = t["date"].strftime("%Y%m%d")
-        name = (t.get("desc") or "")[:32]
-        fitid = _make_fitid(t["date"], name, t["amount"])
-        lines += [
-            "<STMTTRN>",
-            f"<TRNTYPE>{trntype}</TRNTYPE>",
-            f"<DTPOSTED>{dt}</DTPOSTED>",
-            f"<TRNAMT>{amt}</TRNAMT>",
-            f"<FITID>{fitid}</FITID>",
-            f"<NAME>{name}</NAME>",
-            "</STMTTRN>"
-        ]
-
-    # Close list + add balances
-    lines += [
-        "</BANKTRANLIST>",
-        f"<LEDGERBAL><BALAMT>{ending_balance:.2f}</BALAMT><DTASOF>{dtasof}</DTASOF></LEDGERBAL>",
-        f"<AVAILBAL><BALAMT>{ending_balance:.2f}</BALAMT><DTASOF>{dtasof}</DTASOF></AVAILBAL>",
-        "</CCSTMTRS></CCSTMTTRNRS></CREDITCARDMSGSRSV1>",
-    ]
-    lines.append("</OFX>")
+            self.close()
+        return False
 
-    return header + _crlf_join(lines)
+    def _write_part(self, data: bytes):
+        raise NotImplementedError
 
-# ---------- Lambda handler ----------
-def lambda_handler(event, _):
-    # 1) Parse event
-    job_id, doc_loc, job_tag = _extract_job_from_event(event)
-    print({"parsed": {"job_id": job_id, "doc_loc": doc_loc, "job_tag": job_tag}})
+    def _finish(self, tail: bytes):
+        raise NotImplementedError
 
-    # 2) Resolve source bucket/key and get metadata
-    src_bucket, src_key = _resolve_source_keys(doc_loc, job_tag)
-    metadata = _get_s3_metadata(src_bucket, src_key)
+    def abort(self):
+        pass
 
-    # Extract account type and number from metadata
-    account_type = metadata.get('accounttype', 'bank')  # 'bank' or 'credit-card'
-    account_number = metadata.get('accountnumber', '')
+class _S3Writer(_OutputWriter):
+    """
+    Uploads through S3 multipart upload once the output outgrows one chunk;
+    smaller outputs are sent with a single put_object on close.
+    """
 
-    print(f"Processing with account_type={account_type}, account_number={account_number}")
+    def __init__(self, bucket: str, key: str, content_type: str, metadata: Optional[Dict[str, str]] = None,
+                 encoding: str = "utf-8", chunk_size: int = None, client=None):
+        super().__init__(encoding, chunk_size)
+        self.client = client or _s3()
+        self.bucket, self.key = bucket, key
+        self.content_type, self.metadata = content_type, metadata
+        self.location = f"s3://{bucket}/{key}"
+        self._upload_id = None
+        self._parts = []
+
+    def _object_args(self) -> Dict[str, Any]:
+        kw = {"Bucket": self.bucket, "Key": self.key, "ContentType": self.content_type}
+        if self.metadata:
+            kw["Metadata"] = self.metadata
+        return kw
+
+    def _write_part(self, data: bytes):
+        if self._upload_id is None:
+            self._upload_id = self.client.create_multipart_upload(**self._object_args())["UploadId"]
+        n = len(self._parts) + 1
+        res = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                      PartNumber=n, Body=data)
+        self._parts.append({"ETag": res["ETag"], "PartNumber": n})
+
+    def _finish(self, tail: bytes):
+        if self._upload_id is None:
+            self.client.put_object(Body=tail, **self._object_args())
+            return
+        if tail:
+            self._write_part(tail)
+        self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                              MultipartUpload={"Parts": self._parts})
+
+    def abort(self):
+        if self._upload_id is not None:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+            self._upload_id = None
+
+class _FileWriter(_OutputWriter):
+    """Local sink for tests and offline runs; the file appears atomically on close."""
+
+    def __init__(self, path: str, encoding: str = "utf-8", chunk_size: int = None):
+        super().__init__(encoding, chunk_size)
+        self.location = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._tmp = f"{path}.{os.getpid()}.part"
+        self._fh = open(self._tmp, "wb")
+
+    def _write_part(self, data: bytes):
+        self._fh.write(data)
+
+    def _finish(self, tail: bytes):
+        self._fh.write(tail)
+        self._fh.close()
+        os.replace(self._tmp, self.location)
+
+    def abort(self):
+        self._fh.close()
+        if os.path.exists(self._tmp):
+            os.remove(self._tmp)
+
+def _output_location(key: str) -> str:
+    return os.path.join(OUTPUT_LOCAL_DIR, key) if OUTPUT_LOCAL_DIR else f"s3://{_output_bucket()}/{key}"
+
+def _open_output(key: str, content_type: str, metadata: Optional[Dict[str, str]] = None,
+                 encoding: str = "utf-8") -> _OutputWriter:
+    """Writer for an output key: under OUTPUT_LOCAL_DIR when set, otherwise s3://OUTPUT_BUCKET/key."""
+    if OUTPUT_LOCAL_DIR:
+        return _FileWriter(_output_location(key), encoding)
+    return _S3Writer(_output_bucket(), key, content_type, metadata, encoding)
+
+# ---------- Result cache ----------
+def _cache_key(job_id: str, etag: str) -> str:
+    import hashlib
+    digest = hashlib.sha1(f"{job_id}:{etag}".encode("utf-8")).hexdigest()
+    return f"{RESULT_CACHE_PREFIX}{digest}.json"
+
+def _cache_get(job_id: str, etag: str) -> Optional[Dict[str, Any]]:
+    """
+    Result of an earlier run for this Textract job and source ETag, if any.
+    Lives next to the outputs (OUTPUT_LOCAL_DIR or OUTPUT_BUCKET); any read
+    failure is treated as a miss.
+    """
+    if not (RESULT_CACHE and etag):
+        return None
+    key = _cache_key(job_id, etag)
+    try:
+        if OUTPUT_LOCAL_DIR:
+            path = _output_location(key)
+            if not os.path.exists(path):
+                return None
+            with open(path, "rb") as f:
+                body = f.read()
+        else:
+            body = _s3().get_object(Bucket=_output_bucket(), Key=key)["Body"].read()
+        return json.loads(body)
+    except Exception as e:
+        code = getattr(e, "response", {}).get("Error", {}).get("Code")
+        if code not in ("NoSuchKey", "404"):
+            print(f"Result cache read failed for {key}: {e}")
+        return None
 
-    # 3) Get all blocks
-    all_blocks = []
-    page_count = 0
-    for page_result in _iter_pages(job_id):
-        blocks = page_result.get("Blocks", [])
-        all_blocks.extend(blocks)
-        page_count += 1
-        print(f"Retrieved page {page_count} with {len(blocks)} blocks")
+def _cache_put(job_id: str, etag: str, result: Dict[str, Any]):
+    if not (RESULT_CACHE and etag):
+        return
+    key = _cache_key(job_id, etag)
+    try:
+        with _open_output(key, "application/json") as out:
+            out.write(json.dumps(result))
+    except Exception as e:
+        print(f"Result cache write failed for {key}: {e}")
 
-    print(f"Total blocks retrieved: {len(all_blocks)} from {page_count} API calls")
+# ---------- Metrics ----------
+class _Metrics:
+    """
+    Per-invocation stage timings and memory marks, emitted as one structured
+    log record at the end: CloudWatch Embedded Metric Format by default
+    (METRICS_FORMAT=emf), plain JSON lines with METRICS_FORMAT=json, nothing
+    with METRICS_FORMAT=off. Stage times accumulate, so interleaved stages
+    (streamed fetch/extract/write) are reported as totals.
+    """
 
-    # 4) CSV build
-    out_csv = io.StringIO()
-    w = csv.writer(out_csv)
-    table_count = 0
-    all_transactions: List[Dict[str,Any]] = []
+    def __init__(self, entry_point: str):
+        self.entry_point = entry_point
+        self.props: Dict[str, Any] = {}
+        self.ms: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+        self.memory: Dict[str, Dict[str, float]] = {}
+        self._t0 = time.perf_counter()
+        self._tracing = False
+        if METRICS_TRACEMALLOC:
+            import tracemalloc
+            self._tracing = not tracemalloc.is_tracing()
+            if self._tracing:
+                tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name: str):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - t)
+
+    def add(self, name: str, seconds: float):
+        self.ms[name] = self.ms.get(name, 0.0) + seconds * 1000
+
+    def timed(self, name: str, it):
+        """Wraps an iterator, charging the time spent producing each item to `name`."""
+        it = iter(it)
+        while True:
+            t = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                self.add(name, time.perf_counter() - t)
+                return
+            self.add(name, time.perf_counter() - t)
+            yield item
+
+    def mark(self, name: str):
+        """
+        Memory snapshot after a stage: process peak RSS where the platform has
+        `resource` (not Windows), plus traced Python heap with METRICS_TRACEMALLOC.
+        """
+        snap = {}
+        try:
+            import resource
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+            snap["peak_rss_mb"] = round(rss, 1)
+        except ImportError:
+            pass
+        if METRICS_TRACEMALLOC:
+            import tracemalloc
+            cur, peak = tracemalloc.get_traced_memory()
+            snap.update(traced_mb=round(cur / 2**20, 2), traced_peak_mb=round(peak / 2**20, 2))
+        self.memory[name] = snap
+
+    def emit(self):
+        self.ms["total"] = (time.perf_counter() - self._t0) * 1000
+        if self._tracing:
+            import tracemalloc
+            tracemalloc.stop()
+        if METRICS_FORMAT == "off":
+            return
+        values = {f"{k}_ms": round(v, 2) for k, v in self.ms.items()}
+        values.update(self.counts)
+        record = {"entry_point": self.entry_point, **self.props, **values, "memory": self.memory}
+        if METRICS_FORMAT == "emf":
+            record["_aws"] = {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": METRICS_NAMESPACE,
+                    "Dimensions": [["entry_point"]],
+                    "Metrics": ([{"Name": k, "Unit": "Milliseconds"} for k in values if k.endswith("_ms")] +
+                                [{"Name": k, "Unit": "Count"} for k in self.counts]),
+                }],
+            }
+        print(json.dumps(record, default=str))
 
-    pages_with_tables = set()
-    for t, grid in _tables_from_blocks(all_blocks):
-        table_count += 1
-        page_num = t.get('Page', '?')
-        pages_with_tables.add(page_num)
-
-        # Write CSV section
-        w.writerow([f"#TABLE {table_count} (Page {page_num})"])
-        for row in grid:
-            w.writerow(row)
-        w.writerow([])
-
-        # Try extracting transactions from this grid
-        txns = _rows_to_transactions(grid)
-        if txns:
-            print(f"  Table {table_count} on page {page_num}: extracted {len(txns)} transactions")
-            all_transactions.extend(txns)
+# ---------- Block dumps (replay without Textract) ----------
+# Per-block fields kept in a dump; Relationships are stored with Ids remapped to ints
+_DUMP_FIELDS = ("BlockType", "Page", "Text", "RowIndex", "ColumnIndex", "RowSpan", "ColumnSpan",
+                "SelectionStatus", "EntityTypes")
+
+class _BlockDumpWriter:
+    """
+    Writes GetDocumentAnalysis results as a gzip-compressed JSON-lines dump:
+    a header line, then one columnar record per result page (one list per
+    field in _DUMP_FIELDS, plus ids and relationships with Textract's UUIDs
+    remapped to ints). Compresses incrementally into an _OutputWriter, so
+    dumping does not hold the document in memory.
+    """
+
+    def __init__(self, out: _OutputWriter, header: Dict[str, Any]):
+        import zlib
+        self.out = out
+        self._z = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 -> gzip container
+        self._ids: Dict[str, int] = {}
+        self._page = None
+        self._line(dict(header, format="textract-blocks", version=1))
+
+    def _line(self, obj):
+        data = self._z.compress(json.dumps(obj, separators=(",", ":")).encode("utf-8") + b"\n")
+        if data:
+            self.out.write(data)
+
+    def _ref(self, bid: str) -> int:
+        i = self._ids.get(bid)
+        if i is None:
+            i = self._ids[bid] = len(self._ids)
+        return i
+
+    def write_page(self, page_result: Dict[str, Any]):
+        blocks = page_result.get("Blocks", [])
+        cols: Dict[str, list] = {f: [] for f in _DUMP_FIELDS}
+        ids, rels = [], []
+        for b in blocks:
+            ids.append(self._ref(b["Id"]))
+            for f in _DUMP_FIELDS:
+                cols[f].append(b.get(f))
+            r = [[rel["Type"], [self._ref(c) for c in rel["Ids"]]] for rel in b.get("Relationships", [])]
+            rels.append(r or None)
+        # drop all-empty columns to keep records small
+        rec = {f: v for f, v in cols.items() if any(x is not None for x in v)}
+        rec.update(n=len(blocks), Id=ids, Relationships=rels)
+        self._line(rec)
+
+    def close(self):
+        self.out.write(self._z.flush())
+        self.out.close()
+
+def _read_block_dump(fileobj) -> Tuple[Dict[str, Any], Iterator[Dict[str, Any]]]:
+    """
+    Opens a dump written by _BlockDumpWriter from a binary file object (local
+    file or an S3 StreamingBody). Returns (header, pages) where pages yields
+    GetDocumentAnalysis-shaped results, decompressed as they are read.
+    """
+    import gzip
+    lines = gzip.GzipFile(fileobj=fileobj, mode="rb")
+    header = json.loads(lines.readline())
+    if header.get("format") != "textract-blocks":
+        raise ValueError("Not a textract-blocks dump")
+
+    def _pages():
+        for raw in lines:
+            rec = json.loads(raw)
+            cols = [(f, rec[f]) for f in _DUMP_FIELDS if f in rec]
+            blocks = []
+            for i in range(rec["n"]):
+                b = {"Id": str(rec["Id"][i])}
+                for f, vals in cols:
+                    if vals[i] is not None:
+                        b[f] = vals[i]
+                r = rec["Relationships"][i]
+                if r:
+                    b["Relationships"] = [{"Type": t, "Ids": [str(c) for c in ids]} for t, ids in r]
+                blocks.append(b)
+            yield {"Blocks": blocks}
+        lines.close()
+
+    return header, _pages()
+
+def _dumped_pages(pages, dump: _BlockDumpWriter):
+    """Passes pages through while copying each one into the dump; the dump is finished at the end."""
+    ok = False
+    try:
+        for page_result in pages:
+            dump.write_page(page_result)
+            yield page_result
+        ok = True
+    finally:
+        if ok:
+            dump.close()
         else:
-            print(f"  Table {table_count} on page {page_num}: no transactions extracted")
+            dump.out.abort()
+
+# ---------- Page selection (two-phase mode) ----------
+def _page_lines(pages) -> Iterator[Tuple[int, List[str]]]:
+    """(page number, LINE texts) for each document page of GetDocumentTextDetection/Analysis results."""
+    page, lines = None, []
+    for page_result in pages:
+        for b in page_result.get("Blocks", []):
+            if b["BlockType"] != "LINE":
+                continue
+            bpage = b.get("Page", 1)
+            if page is not None and bpage != page:
+                yield page, lines
+                lines = []
+            page = bpage
+            lines.append(b.get("Text") or "")
+    if page is not None:
+        yield page, lines
+
+def _is_transaction_page(lines: List[str], headers: _HeaderMatcher) -> bool:
+    """
+    Page-level counterpart of _is_transaction_table on LINE text, where each
+    table cell is a line of its own: three lines that are just a date, or one
+    under a header naming a date and an amount column. Pages printing the
+    opening/closing balance (the phrase, then an amount on the next line) also
+    pass, so _reconcile still gets them.
+    """
+    dated = sum(bool(_DATELIKE_RE.fullmatch(s.strip())) for s in lines)
+    if dated >= 3:
+        return True
+    for label, value in zip(lines, lines[1:]):
+        if (_OPENING_RE.search(label) or _CLOSING_RE.search(label)) and _parse_amount(value) is not None:
+            return True
+    text = "\n".join(lines)
+    fields = {headers.fields.get(m.group(0)) for m in headers.pattern.finditer(_fold(text))}
+    return dated > 0 and "date" in fields and not fields.isdisjoint(("amount", "debit", "credit"))
+
+def _select_pages(pages, headers: _HeaderMatcher = None) -> Tuple[List[int], int]:
+    """Returns (pages worth a TABLES analysis, total pages) from a job's result pages."""
+    headers = headers or _header_matcher()
+    wanted, total = [], 0
+    for page, lines in _page_lines(pages):
+        total = max(total, page)
+        if _is_transaction_page(lines, headers):
+            wanted.append(page)
+    return wanted, total
+
+def _pdf_pages(data: bytes, pages: List[int]) -> Optional[bytes]:
+    """
+    A PDF holding only the given 1-based pages of the PDF in `data`, or None
+    when pypdf is not available (it ships as a layer, not in the function zip).
+    """
+    try:
+        from pypdf import PdfReader, PdfWriter
+    except ImportError:
+        print("pypdf not available; analyzing every page")
+        return None
+    import io
+    reader = PdfReader(io.BytesIO(data))
+    writer = PdfWriter()
+    for p in pages:
+        writer.add_page(reader.pages[p - 1])
+    out = io.BytesIO()
+    writer.write(out)
+    return out.getvalue()
+
+def _start_tables_analysis(bucket: str, key: str, token: str = None) -> str:
+    """Starts an async TABLES analysis notifying TEXTRACT_SNS_TOPIC_ARN (-> lambda_handler); returns its JobId."""
+    if not TEXTRACT_SNS_TOPIC_ARN or not TEXTRACT_ROLE_ARN:
+        raise RuntimeError("TEXTRACT_SNS_TOPIC_ARN and TEXTRACT_ROLE_ARN must be set to start Textract jobs")
+    kw = {"ClientRequestToken": token} if token else {}
+    resp = _textract().start_document_analysis(
+        DocumentLocation={"S3Object": {"Bucket": bucket, "Name": key}},
+        FeatureTypes=["TABLES"],
+        NotificationChannel={"SNSTopicArn": TEXTRACT_SNS_TOPIC_ARN, "RoleArn": TEXTRACT_ROLE_ARN},
+        **kw)
+    print(f"Started TABLES analysis {resp['JobId']} on s3://{bucket}/{key}")
+    return resp["JobId"]
+
+# ---------- PDF text layer ----------
+def _pdf_text_runs(page) -> List[Tuple[float, float, float, str]]:
+    """
+    (x0, x1, y, text) for each text run pypdf shows on a page, in page
+    coordinates. Only the start of a run is positioned, so x1 (and the place
+    of pieces split off at runs of spaces) is estimated from the font size.
+    """
+    runs = []
+
+    def _visit(text, cm, tm, font, size):
+        text = text.replace("\n", " ")
+        if not text.strip():
+            return
+        x = tm[4] * cm[0] + tm[5] * cm[2] + cm[4]
+        y = tm[4] * cm[1] + tm[5] * cm[3] + cm[5]
+        char_w = 0.5 * (size or 10) * (abs(tm[0] * cm[0]) or 1.0)
+        for m in re.finditer(r"\S+(?: \S+)*", text):
+            runs.append((x + m.start() * char_w, x + m.end() * char_w, y, m.group()))
+
+    page.extract_text(visitor_text=_visit)
+    return runs
+
+def _text_lines(runs: List[Tuple[float, float, float, str]], y_tol: float = 2.0) -> List[List[List[Any]]]:
+    """
+    Groups runs into lines, top of the page first, each a left-to-right list
+    of [x0, x1, text] segments. Only runs that all but touch are joined:
+    neighbouring columns (a wrapped "de cheque" next to "Descripción") can
+    be a single space apart, and _grids_from_lines joins a cell's words.
+    """
+    lines, last_y = [], None
+    for x0, x1, y, text in sorted(runs, key=lambda r: (-r[2], r[0])):
+        if last_y is None or last_y - y > y_tol:
+            lines.append([])
+            last_y = y
+        lines[-1].append([x0, x1, text])
+    out = []
+    for line in lines:
+        line.sort()
+        segs = [line[0]]
+        for x0, x1, text in line[1:]:
+            prev = segs[-1]
+            char_w = (prev[1] - prev[0]) / max(1, len(prev[2]))
+            if x0 - prev[1] < 0.25 * char_w:
+                prev[1], prev[2] = max(prev[1], x1), f"{prev[2]} {text}"
+            else:
+                segs.append([x0, x1, text])
+        out.append(segs)
+    return out
 
-    print(f"Found {table_count} tables across pages: {sorted(pages_with_tables)}")
+def _overlap(seg: List[Any], col: List[float]) -> float:
+    # Shared width of a segment and a column span; negative is the gap between them
+    return min(seg[1], col[1]) - max(seg[0], col[0])
+
+def _grids_from_lines(lines: List[List[List[Any]]], headers: _HeaderMatcher,
+                      columns: List[List[float]] = None) -> Tuple[List[List[List[str]]], Optional[List[List[float]]]]:
+    """
+    Rebuilds one page's transaction tables from its text lines. A table
+    starts at a header line (a date and an amount column, per `headers`);
+    each header segment is a column spanning [x0, x1], and lines up to the
+    first row add wrapped header words to the column they overlap (or a new
+    column where they overlap none, as "Descripción" under a two-line
+    header). Cells go to the column they overlap most, else the nearest,
+    so right-aligned amounts land under their own header. A row starts at a
+    line whose first token is a date; text-only lines continue the row above,
+    and a line with amounts in cents but no date (totals) ends the table.
+    `columns` carries a table left open at the end of the previous page.
+    Returns (grids, columns to carry).
+    """
+    grids: List[List[List[str]]] = []
+    grid, header, row = None, None, None
+    if columns:
+        grid = []
+
+    def _nearest(seg):
+        return max(range(len(columns)), key=lambda i: _overlap(seg, columns[i]))
+
+    def _place(cells, segs):
+        for seg in segs:
+            i = _nearest(seg)
+            cells[i] = f"{cells[i]} {seg[2]}" if cells[i] else seg[2]
+
+    def _close():
+        if grid and any(r is not header for r in grid):
+            grids.append(grid)
+
+    for segs in lines:
+        text = " ".join(t for _, _, t in segs)
+        first = segs[0][2].split(" ", 1)
+        if _DATELIKE_RE.fullmatch(first[0]):
+            if grid is None:
+                continue
+            if len(first) > 1:
+                # Date and description ran together: split at the date's estimated width
+                x0, x1, _ = segs[0]
+                cut = x0 + (x1 - x0) * (len(first[0]) + 1) / len(segs[0][2])
+                segs = [[x0, cut, first[0]], [cut, x1, first[1]]] + segs[1:]
+            row = [""] * len(columns)
+            _place(row, segs)
+            grid.append(row)
+            header = None
+            continue
+        fields = {headers.fields.get(m.group(0)) for m in headers.pattern.finditer(_fold(text))}
+        if "date" in fields and not fields.isdisjoint(("amount", "debit", "credit")):
+            _close()
+            columns = [[x0, x1] for x0, x1, _ in segs]
+            header = [t for _, _, t in segs]
+            grid, row = [header], None
+            continue
+        if grid is None:
+            continue
+        if any("." in t and _parse_amount(t) is not None for _, _, t in segs):
+            _close()
+            grid = header = row = columns = None
+        elif header is not None:
+            for seg in segs:
+                i = _nearest(seg)
+                if _overlap(seg, columns[i]) > 0:
+                    header[i] = f"{header[i]} {seg[2]}"
+                    columns[i] = [min(columns[i][0], seg[0]), max(columns[i][1], seg[1])]
+                else:
+                    i = sum(c[0] < seg[0] for c in columns)
+                    columns.insert(i, [seg[0], seg[1]])
+                    header.insert(i, seg[2])
+        elif row is not None:
+            _place(row, segs)
+    _close()
+    return grids, columns if grid is not None else None
+
+def _text_layer_pages(data: bytes, headers: _HeaderMatcher = None,
+                      min_chars: int = 20) -> Optional[Tuple[List[Dict[str, Any]], List[int]]]:
+    """
+    GetDocumentAnalysis-shaped results for a PDF read from its own text layer,
+    one per page: a LINE block per text line and TABLE/CELL/WORD blocks (one
+    WORD per cell) for the grids _grids_from_lines rebuilds, so _convert and
+    block dumps take them like Textract output. Returns (pages, scanned page
+    numbers): a page with fewer than `min_chars` characters of text but an
+    image is scanned and left empty for Textract; one with no image either
+    is just blank. None when pypdf is missing or `data` is not a readable PDF.
+    """
+    try:
+        from pypdf import PdfReader
+        from pypdf.errors import PyPdfError
+    except ImportError:
+        print("pypdf not available; no text-layer extraction")
+        return None
+    if not data.startswith(b"%PDF"):
+        return None
+    import io
+    headers = headers or _header_matcher()
+    pages, scanned, columns, next_id = [], [], None, 0
 
-    if table_count == 0:
-        w.writerow(["#NO_TABLES_FOUND"])
+    def _block(**b):
+        nonlocal next_id
+        next_id += 1
+        b["Id"] = str(next_id)
+        blocks.append(b)
+        return b["Id"]
 
-    csv_bytes = out_csv.getvalue().encode("utf-8-sig")
+    try:
+        for page_no, page in enumerate(PdfReader(io.BytesIO(data)).pages, 1):
+            blocks: List[Dict[str, Any]] = []
+            pages.append({"Blocks": blocks})
+            runs = _pdf_text_runs(page)
+            if sum(len(r[3]) for r in runs) < min_chars and len(page.images):
+                print(f"Page {page_no} has no text layer")
+                scanned.append(page_no)
+                columns = None
+                continue
+            lines = _text_lines(runs)
+            grids, columns = _grids_from_lines(lines, headers, columns)
+            for segs in lines:
+                _block(BlockType="LINE", Page=page_no, Text=" ".join(t for _, _, t in segs))
+            for grid in grids:
+                cell_ids: List[str] = []
+                _block(BlockType="TABLE", Page=page_no, Relationships=[{"Type": "CHILD", "Ids": cell_ids}])
+                for r, cells in enumerate(grid, 1):
+                    for c, value in enumerate(cells, 1):
+                        words = [_block(BlockType="WORD", Page=page_no, Text=value)] if value else []
+                        cell_ids.append(_block(BlockType="CELL", Page=page_no, RowIndex=r, ColumnIndex=c,
+                                               Relationships=[{"Type": "CHILD", "Ids": words}]))
+    except PyPdfError as e:
+        print(f"Unreadable PDF: {e}")
+        return None
+    return pages, scanned
+
+def _renumbered_pages(pages, source_pages: List[int]):
+    """Results for a page_select_handler/upload_handler copy with each block's Page set back to the original's."""
+    for page_result in pages:
+        for b in page_result.get("Blocks", []):
+            if "Page" in b:
+                b["Page"] = source_pages[b["Page"] - 1]
+        yield page_result
+
+def _merged_pages(*sources):
+    """Page-ordered result streams with disjoint pages (Textract and the text layer) as one, a result per page."""
+    import heapq, itertools
+    blocks = heapq.merge(*((b for r in src for b in r.get("Blocks", [])) for src in sources),
+                         key=lambda b: b.get("Page", 1))
+    for _, group in itertools.groupby(blocks, key=lambda b: b.get("Page", 1)):
+        yield {"Blocks": list(group)}
+
+def _with_text_layer(pages, metadata: Dict[str, str]) -> Tuple[Any, Dict[str, str]]:
+    """
+    For the scanned-pages copy upload_handler sends to Textract: merges the
+    job's pages with the text-layer pages it stored under "textlayer", in
+    original page order. Returns (pages, metadata for _convert); other jobs
+    pass through unchanged.
+    """
+    key = metadata.get('textlayer')
+    if not key:
+        return pages, metadata
+    source_pages = [int(p) for p in metadata.get('sourcepages', '').split(",") if p.isdigit()]
+    if OUTPUT_LOCAL_DIR:
+        fileobj = open(_output_location(key), "rb")
+    else:
+        fileobj = _s3().get_object(Bucket=_output_bucket(), Key=key)["Body"]
+    _, text_pages = _read_block_dump(fileobj)
+    print(f"Merging Textract pages {source_pages} with the text layer from {key}")
+    metadata = {k: v for k, v in metadata.items() if k not in ('sourcepages', 'textlayer')}
+    return _merged_pages(_renumbered_pages(pages, source_pages), text_pages), metadata
 
-    # 5) Decide base names - use original filename from metadata if available
+# ---------- Lambda handler ----------
+def _output_base(metadata: Dict[str, str], src_key: str) -> str:
+    """Base name for output keys - the original filename from metadata if available."""
     original_name = metadata.get('originalname', '')
     if original_name:
         base = original_name.rsplit(".", 1)[0] or "document"
@@ -574,52 +1875,482 @@ def lambda_handler(event, _):
         base = os.path.basename(src_key).rsplit(".", 1)[0] or "document"
 
     # Clean filename: remove spaces and special chars
-    base = base.replace(" ", "_").replace("(", "").replace(")", "")
+    return base.replace(" ", "_").replace("(", "").replace(")", "")
 
+def _convert(pages, metadata: Dict[str, str], src_key: str, metrics: _Metrics,
+             defer_close=None) -> Tuple[Dict[str, Any], bool]:
+    """
+    Runs tables -> CSV -> transactions -> QBO over an iterable of
+    GetDocumentAnalysis results. Shared by lambda_handler (live Textract) and
+    replay_handler (stored block dumps). Returns (result, qbo_written).
+    `defer_close(fn)` runs the CSV upload's close elsewhere and returns a
+    future, so it can finish while the QBO is built.
+    """
+    # Extract account type and number from metadata
+    account_type = metadata.get('accounttype', 'bank')  # 'bank' or 'credit-card'
+    account_number = metadata.get('accountnumber', '')
+
+    print(f"Processing with account_type={account_type}, account_number={account_number}")
+
+    # Page numbers of a page_select_handler copy are reported as in the original document
+    source_pages = [int(p) for p in metadata.get('sourcepages', '').split(",") if p.isdigit()]
+
+    # Statement period for month/day-only dates: "statementdate" metadata (its last day), else page 1's text
+    period = _StatementPeriod(_parse_date(metadata.get('statementdate', '')))
+
+    # 3) Get blocks (streamed table by table, or all at once)
+    stats = {"pages": 0, "blocks": 0}
+    def _logged_pages():
+        for page_result in period.tap(metrics.timed("page_fetch", pages)):
+            n = len(page_result.get("Blocks", []))
+            stats["pages"] += 1
+            stats["blocks"] += n
+            print(f"Retrieved page {stats['pages']} with {n} blocks")
+            yield page_result
+
+    # Streamed tables pull pages as they go; page_fetch is taken back out of table_extraction below
+    if STREAM_TABLES:
+        tables = _stream_tables(_logged_pages())
+    else:
+        all_blocks = []
+        for page_result in _logged_pages():
+            all_blocks.extend(page_result.get("Blocks", []))
+        tables = _tables_from_blocks(all_blocks)
+    tables = metrics.timed("table_extraction", tables)
+
+    # 4) Decide output names
+    base = _output_base(metadata, src_key)
     csv_key = f"{OUTPUT_PREFIX}{base}.tables.csv"
     qbo_key = f"{OUTPUT_PREFIX}{base}.qbo"
 
-    # 6) Write CSV
-    s3.put_object(Bucket=OUTPUT_BUCKET, Key=csv_key, Body=csv_bytes, ContentType="text/csv")
-    print(f"Wrote CSV s3://{OUTPUT_BUCKET}/{csv_key}")
 
-    # 7) Build + write QBO (choose format based on account type)
-    try:
-        print(f"DEBUG: Checking account_type value: '{account_type}' (type: {type(account_type).__name__})")
-        print(f"DEBUG: Comparison result: account_type == 'credit-card' -> {account_type == 'credit-card'}")
+    # 5) Stream the CSV out while extracting transactions
+    table_count = 0
+    all_transactions: List[Dict[str,Any]] = []
 
-        if account_type == 'credit-card':
-            print("Using CREDIT CARD QBO format")
-            qbo_text = _build_creditcard_qbo(all_transactions, account_number)
-            print(f"Built credit card QBO with {len(all_transactions)} transactions")
-        else:
-            print(f"Using BANK QBO format (account_type was '{account_type}')")
-            qbo_text = _build_bank_qbo(all_transactions, account_number)
-            print(f"Built bank account QBO with {len(all_transactions)} transactions")
-
-        s3.put_object(
-            Bucket=OUTPUT_BUCKET,
-            Key=qbo_key,
-            Body=qbo_text.encode("utf-8"),
-            ContentType="application/vnd.intu.qbo",
-            Metadata={
+    pages_with_tables = set()
+    schema = _TableSchema(metadata.get('headerprofile'), period)
+    balances: Dict[str, Any] = {}
+    skipped_tables = 0
+    import csv
+    with _open_output(csv_key, "text/csv", encoding="utf-8-sig") as out_csv:
+        out_csv.defer = defer_close
+        w = csv.writer(out_csv)
+        for t, grid in tables:
+            table_count += 1
+            page_num = t.page
+            if isinstance(page_num, int) and 0 < page_num <= len(source_pages):
+                page_num = source_pages[page_num - 1]
+            pages_with_tables.add(page_num)
+
+            with metrics.stage("classify_tables"):
+                is_txn = not CLASSIFY_TABLES or _is_transaction_table(grid, headers=schema.headers)
+
+            # Write CSV section
+            if is_txn or not CSV_TRANSACTION_TABLES_ONLY:
+                with metrics.stage("csv_write"):
+                    w.writerow([f"#TABLE {table_count} (Page {page_num})"])
+                    w.writerows(grid)
+                    w.writerow([])
+
+            # Try extracting transactions from this grid (continuation tables reuse the last layout)
+            with metrics.stage("transaction_extraction"):
+                txns = _rows_to_transactions(grid, schema) if is_txn else []
+                if not txns:
+                    _statement_balances(grid, balances)
+            if txns:
+                print(f"  Table {table_count} on page {page_num}: extracted {len(txns)} transactions")
+                all_transactions.extend(txns)
+            elif not is_txn:
+                skipped_tables += 1
+                print(f"  Table {table_count} on page {page_num}: skipped (not a transaction table)")
+            else:
+                print(f"  Table {table_count} on page {page_num}: no transactions extracted")
+
+        if table_count == 0:
+            w.writerow(["#NO_TABLES_FOUND"])
+        csv_closed_at = time.perf_counter()
+    metrics.add("csv_write", time.perf_counter() - csv_closed_at)
+    if STREAM_TABLES:
+        metrics.ms["table_extraction"] = metrics.ms.get("table_extraction", 0.0) - metrics.ms.get("page_fetch", 0.0)
+    metrics.counts.update(pages=stats["pages"], blocks=stats["blocks"], tables=table_count,
+                          tables_skipped=skipped_tables, transactions=len(all_transactions))
+    metrics.mark("extraction")
+
+    print(f"Total blocks retrieved: {stats['blocks']} from {stats['pages']} API calls")
+    print(f"Found {table_count} tables across pages: {sorted(pages_with_tables)}")
+    print(f"Wrote CSV {out_csv.location}")
+    csv_location = out_csv.location
+    qbo_location = _output_location(qbo_key)
+
+    # Running balances vs the statement's printed balances; LEDGERBAL gets the real closing balance
+    with metrics.stage("reconcile"):
+        recon = _reconcile(all_transactions, balances.get("opening"), balances.get("closing"))
+    metrics.counts["balance_gaps"] = len(recon["gaps"])
+    print(f"Reconciliation: reconciled={recon['reconciled']} opening={recon['opening']} "
+          f"closing={recon['closing']} checked={recon['checked']} gaps={len(recon['gaps'])}")
+    for gap in recon["gaps"][:20]:
+        print(f"  Balance gap: {gap}")
+
+    # 6) Build + write QBO (choose format based on account type)
+    qbo_ok = False
+    if RECONCILE_REQUIRED and not recon["reconciled"]:
+        print("QBO not written: balances do not reconcile (RECONCILE_REQUIRED)")
+    else:
+        try:
+            print(f"DEBUG: Checking account_type value: '{account_type}' (type: {type(account_type).__name__})")
+            print(f"DEBUG: Comparison result: account_type == 'credit-card' -> {account_type == 'credit-card'}")
+
+            if account_type == 'credit-card':
+                print("Using CREDIT CARD QBO format")
+            else:
+                print(f"Using BANK QBO format (account_type was '{account_type}')")
+            account = _qbo_account(account_type, account_number)
+
+            qbo_meta = {
                 'accounttype': account_type,
                 'accountnumber': account_number,
                 'transactioncount': str(len(all_transactions))
             }
-        )
-        print(f"Wrote QBO s3://{OUTPUT_BUCKET}/{qbo_key} (type={account_type}, txns={len(all_transactions)})")
-    except Exception as e:
-        import traceback
-        print(f"QBO build error: {str(e)}")
-        print(f"Traceback: {traceback.format_exc()}")
-
-    return {
+            with metrics.stage("qbo_write"), _open_output(qbo_key, "application/vnd.intu.qbo", qbo_meta) as out_qbo:
+                for chunk in _iter_ofx(all_transactions, account, ledger_balance=recon["closing"]):
+                    out_qbo.write(chunk)
+            print(f"Wrote QBO {out_qbo.location} (type={account_type}, txns={len(all_transactions)})")
+            qbo_ok = True
+        except Exception as e:
+            import traceback
+            print(f"QBO build error: {str(e)}")
+            print(f"Traceback: {traceback.format_exc()}")
+    if out_csv.pending is not None:
+        out_csv.pending.result()  # the CSV is the primary output; its upload errors still fail the job
+    metrics.mark("qbo_write")
+
+    result = {
         "ok": True,
-        "csv": f"s3://{OUTPUT_BUCKET}/{csv_key}",
-        "qbo": f"s3://{OUTPUT_BUCKET}/{qbo_key}",
+        "csv": csv_location,
+        "qbo": qbo_location,
         "tables": table_count,
         "transactions": len(all_transactions),
         "accountType": account_type,
-        "accountNumber": account_number
+        "accountNumber": account_number,
+        "statementEnd": f"{period.end:%Y-%m-%d}" if period.end else None,
+        "reconciliation": recon
     }
+    return result, qbo_ok
+
+def lambda_handler(event, _):
+    metrics = _Metrics("lambda_handler")
+
+    # 1) Parse event
+    with metrics.stage("event_parse"):
+        job_id, doc_loc, job_tag = _extract_job_from_event(event)
+    return _process_job(job_id, doc_loc, job_tag, metrics)
+
+def _cached_result(job_id: str, etag: str, metrics: _Metrics) -> Optional[Dict[str, Any]]:
+    """The earlier result of an unchanged job (emitting the invocation's metrics), else None."""
+    with metrics.stage("cache_lookup"):
+        cached = _cache_get(job_id, etag)
+    if cached is None:
+        return None
+    print(f"Result cache hit for job {job_id} (etag {etag}): {cached.get('csv')}, {cached.get('qbo')}")
+    metrics.counts["cache_hit"] = 1
+    metrics.emit()
+    return dict(cached, cached=True)
+
+def _dump_pages(pages, job_id: str, src_bucket: str, src_key: str, etag: str,
+                metadata: Dict[str, str]) -> Tuple[Any, Optional[str]]:
+    """With SAVE_BLOCKS, copies the pages into a block dump next to the CSV; returns (pages, dump key or None)."""
+    if not SAVE_BLOCKS:
+        return pages, None
+    blocks_key = f"{OUTPUT_PREFIX}{_output_base(metadata, src_key)}.blocks.jsonl.gz"
+    header = {"job_id": job_id, "source": f"s3://{src_bucket}/{src_key}", "etag": etag, "metadata": metadata}
+    return _dumped_pages(pages, _BlockDumpWriter(_open_output(blocks_key, "application/gzip"), header)), blocks_key
+
+def _convert_job(pages, metadata: Dict[str, str], src_key: str, job_id: str, etag: str,
+                 blocks_key: Optional[str], metrics: _Metrics, defer_close=None) -> Dict[str, Any]:
+    """_convert for a Textract job: records the dump location, caches a complete result and emits the metrics."""
+    try:
+        result, qbo_ok = _convert(pages, metadata, src_key, metrics, defer_close)
+        if blocks_key:
+            result["blocks"] = _output_location(blocks_key)
+        if qbo_ok:
+            _cache_put(job_id, etag, result)
+        metrics.counts["cache_hit"] = 0
+    finally:
+        metrics.emit()
+    return result
+
+def _process_job(job_id: str, doc_loc: Optional[dict], job_tag: Optional[str], metrics: _Metrics) -> Dict[str, Any]:
+    print({"parsed": {"job_id": job_id, "doc_loc": doc_loc, "job_tag": job_tag}})
+    metrics.props["job_id"] = job_id
+
+    # 2) Resolve source bucket/key and get metadata
+    src_bucket, src_key = _resolve_source_keys(doc_loc, job_tag)
+    with metrics.stage("head_object"):
+        metadata, etag = _head_source(src_bucket, src_key)
+    metrics.props.update(source=f"s3://{src_bucket}/{src_key}", account_type=metadata.get('accounttype', 'bank'))
+    metrics.mark("head_object")
+
+    # Duplicate SNS deliveries and manual re-runs of an unchanged document reuse the earlier outputs
+    cached = _cached_result(job_id, etag, metrics)
+    if cached is not None:
+        return cached
+
+    pages = _prefetch_pages(job_id) if PREFETCH_PAGES > 0 else _iter_pages(job_id)
+    pages, metadata = _with_text_layer(pages, metadata)
+
+    # Optionally keep the raw blocks next to the CSV so parsing changes can be replayed without Textract
+    pages, blocks_key = _dump_pages(pages, job_id, src_bucket, src_key, etag, metadata)
+    return _convert_job(pages, metadata, src_key, job_id, etag, blocks_key, metrics)
+
+async def _process_job_async(job_id: str, doc_loc: Optional[dict], job_tag: Optional[str],
+                             metrics: _Metrics) -> Dict[str, Any]:
+    """
+    _process_job with the independent I/O overlapped: without the result
+    cache, head_object and the first result page are in flight together
+    (with it, Textract is not called until the lookup has missed), and the
+    CSV upload finishes while the QBO is built. Blocking client calls run on
+    the default executor.
+    """
+    import asyncio
+    print({"parsed": {"job_id": job_id, "doc_loc": doc_loc, "job_tag": job_tag}})
+    metrics.props["job_id"] = job_id
+    loop = asyncio.get_running_loop()
+    client = _textract()
+
+    src_bucket, src_key = _resolve_source_keys(doc_loc, job_tag)
+    first = None
+    with metrics.stage("head_object"):
+        if RESULT_CACHE:
+            metadata, etag = await asyncio.to_thread(_head_source, src_bucket, src_key)
+        else:
+            (metadata, etag), first = await asyncio.gather(
+                asyncio.to_thread(_head_source, src_bucket, src_key),
+                asyncio.to_thread(_get_page, client, job_id, None))
+    metrics.props.update(source=f"s3://{src_bucket}/{src_key}", account_type=metadata.get('accounttype', 'bank'))
+    metrics.mark("head_object")
+
+    cached = await asyncio.to_thread(_cached_result, job_id, etag, metrics)
+    if cached is not None:
+        return cached
+
+    if PREFETCH_PAGES > 0:
+        pages = _prefetch_pages(job_id, client=client, first=first)
+    else:
+        pages = _iter_pages(job_id, client, first)
+    pages, metadata = await asyncio.to_thread(_with_text_layer, pages, metadata)
+    pages, blocks_key = _dump_pages(pages, job_id, src_bucket, src_key, etag, metadata)
+
+    def _defer(fn):
+        return asyncio.run_coroutine_threadsafe(asyncio.to_thread(fn), loop)
+
+    return await asyncio.to_thread(_convert_job, pages, metadata, src_key, job_id, etag, blocks_key, metrics, _defer)
+
+def async_handler(event, _):
+    """lambda_handler on an asyncio pipeline; same event, outputs and result."""
+    import asyncio
+    metrics = _Metrics("async_handler")
+    with metrics.stage("event_parse"):
+        job_id, doc_loc, job_tag = _extract_job_from_event(event)
+    return asyncio.run(_process_job_async(job_id, doc_loc, job_tag, metrics))
+
+def batch_handler(event, _):
+    """
+    Converts every completed job in an SQS (or SNS) batch, BATCH_WORKERS at a
+    time on threads sharing the boto3 clients. For SQS, enable
+    ReportBatchItemFailures on the event source mapping: only the failed
+    messages go back to the queue, and a redelivered job that had already
+    finished is answered from the result cache.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    records = event.get("Records") or []
+    failures: List[Dict[str, str]] = []
+
+    def _run(rec):
+        metrics = _Metrics("batch_handler")
+        with metrics.stage("event_parse"):
+            job_id, doc_loc, job_tag = _job_from_record(rec)
+        return _process_job(job_id, doc_loc, job_tag, metrics)
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=min(BATCH_WORKERS, len(records) or 1)) as pool:
+        futures = [(rec, pool.submit(_run, rec)) for rec in records]
+        for rec, fut in futures:
+            try:
+                fut.result()
+            except Exception as e:
+                import traceback
+                print(f"Batch record {_record_id(rec)} failed: {e}")
+                print(f"Traceback: {traceback.format_exc()}")
+                failures.append({"itemIdentifier": _record_id(rec)})
+    print(f"Batch done: {len(records) - len(failures)}/{len(records)} jobs in {time.perf_counter() - t0:.2f}s")
+
+    # SNS has no partial-failure response; fail the invocation so the retry re-runs (cheaply, via the cache)
+    if failures and any(rec.get("EventSource") == "aws:sns" for rec in records):
+        raise RuntimeError(f"{len(failures)} of {len(records)} jobs failed")
+    return {"batchItemFailures": failures}
+
+def page_select_handler(event, _):
+    """
+    Phase one of the two-phase mode, subscribed to the notifications of
+    StartDocumentTextDetection jobs (the cheap pass). Finds the pages with
+    transaction tables in the LINE blocks (_select_pages), copies just those
+    pages into OUTPUT_BUCKET and starts the TABLES analysis of the copy, whose
+    completion goes to lambda_handler through TEXTRACT_SNS_TOPIC_ARN. The copy
+    carries the source metadata plus "sourcepages" (original page numbers) and
+    "statementdate", read from page 1 before it is dropped. Without pypdf, or
+    when every page qualifies, the source document is analyzed as it is.
+    """
+    metrics = _Metrics("page_select_handler")
+    with metrics.stage("event_parse"):
+        job_id, doc_loc, job_tag = _extract_job_from_event(event)
+    metrics.props["job_id"] = job_id
+    src_bucket, src_key = _resolve_source_keys(doc_loc, job_tag)
+    with metrics.stage("head_object"):
+        metadata, _ = _head_source(src_bucket, src_key)
+    metrics.props["source"] = f"s3://{src_bucket}/{src_key}"
+
+    try:
+        period = _StatementPeriod(_parse_date(metadata.get('statementdate', '')))
+        with metrics.stage("page_select"):
+            pages = _iter_pages(job_id, api="get_document_text_detection")
+            wanted, total = _select_pages(period.tap(pages), _header_matcher(metadata.get('headerprofile')))
+        print(f"Transaction pages {wanted} of {total}")
+        metrics.counts.update(pages=total, pages_selected=len(wanted))
+
+        document = {"Bucket": src_bucket, "Name": src_key}
+        body = None
+        if wanted and len(wanted) < total:
+            with metrics.stage("page_copy"):
+                body = _pdf_pages(_s3().get_object(Bucket=src_bucket, Key=src_key)["Body"].read(), wanted)
+        if body is not None:
+            meta = dict(metadata, originalname=metadata.get('originalname') or os.path.basename(src_key),
+                        sourcepages=",".join(map(str, wanted)))
+            if period.end:
+                meta["statementdate"] = f"{period.end:%Y-%m-%d}"
+            document = {"Bucket": _output_bucket(), "Name": f"{OUTPUT_PREFIX}pages/{_output_base(metadata, src_key)}.pdf"}
+            _s3().put_object(Bucket=document["Bucket"], Key=document["Name"], Body=body,
+                             ContentType="application/pdf", Metadata=meta)
+
+        with metrics.stage("start_analysis"):
+            # The text job's id makes a redelivered notification start the same analysis job, not a second one
+            analysis_job = _start_tables_analysis(document["Bucket"], document["Name"], token=job_id)
+    finally:
+        metrics.emit()
+    return {"ok": True, "analysisJobId": analysis_job, "document": f"s3://{document['Bucket']}/{document['Name']}",
+            "pages": wanted if body is not None else list(range(1, total + 1)), "totalPages": total}
+
+# What StartDocumentAnalysis reads: extension -> content type
+_DOCUMENT_TYPES = {".pdf": "application/pdf", ".png": "image/png", ".jpg": "image/jpeg",
+                   ".jpeg": "image/jpeg", ".tif": "image/tiff", ".tiff": "image/tiff"}
+
+def _is_document(bucket: str, key: str) -> bool:
+    """
+    A PDF or image Textract can read: by extension, or for keys without one
+    by the object's ContentType. This function's outputs and the result
+    cache in OUTPUT_BUCKET never are.
+    """
+    if bucket == OUTPUT_BUCKET and key.startswith((OUTPUT_PREFIX, RESULT_CACHE_PREFIX)):
+        return False
+    ext = os.path.splitext(key)[1].lower()
+    if ext:
+        return ext in _DOCUMENT_TYPES
+    try:
+        content_type = _s3().head_object(Bucket=bucket, Key=key).get("ContentType", "")
+    except Exception as e:
+        print(f"Could not read the content type of s3://{bucket}/{key}: {e}")
+        return False
+    return content_type.split(";")[0].strip().lower() in _DOCUMENT_TYPES.values()
+
+def upload_handler(event, _):
+    """
+    Converts uploaded PDFs straight from their text layer, subscribed to the
+    source bucket's ObjectCreated events. Digitally generated statements go
+    through _convert in one invocation, without waiting on a Textract job.
+    When some pages are scanned, only those go to Textract: they are copied
+    into OUTPUT_BUCKET with "sourcepages" metadata, the text-layer pages are
+    stored as a block dump named by "textlayer", and lambda_handler merges
+    the two (_with_text_layer). Images, wholly scanned PDFs, layouts no table
+    could be rebuilt from, or a missing pypdf send the whole document to
+    Textract. Anything else (_is_document), including this function's
+    outputs and the result cache, is ignored.
+    """
+    from urllib.parse import unquote_plus
+    results = []
+    for rec in event.get("Records") or []:
+        bucket = rec["s3"]["bucket"]["name"]
+        key = unquote_plus(rec["s3"]["object"]["key"])
+        if not _is_document(bucket, key):
+            print(f"Ignoring s3://{bucket}/{key}: not a PDF or image upload")
+            continue
+        metrics = _Metrics("upload_handler")
+        metrics.props["source"] = f"s3://{bucket}/{key}"
+        try:
+            with metrics.stage("head_object"):
+                metadata, _etag = _head_source(bucket, key)
+            with metrics.stage("text_layer"):
+                data = _s3().get_object(Bucket=bucket, Key=key)["Body"].read()
+                layer = _text_layer_pages(data, _header_matcher(metadata.get('headerprofile')))
+            pages, scanned = layer or (None, [])
+            if pages is not None and len(scanned) == len(pages):
+                pages = None
+            elif pages is not None and not scanned and not any(b["BlockType"] == "TABLE" for p in pages for b in p["Blocks"]):
+                print("No transaction table found in the text layer")
+                pages = None
+
+            if pages is None:
+                with metrics.stage("start_analysis"):
+                    results.append({"ok": True, "source": "textract",
+                                    "analysisJobId": _start_tables_analysis(bucket, key)})
+            elif scanned:
+                base = f"{OUTPUT_PREFIX}pages/{_output_base(metadata, key)}"
+                with metrics.stage("page_copy"):
+                    dump = _BlockDumpWriter(_open_output(f"{base}.textlayer.jsonl.gz", "application/gzip"),
+                                            {"source": f"s3://{bucket}/{key}", "metadata": metadata})
+                    for page_no, page_result in enumerate(pages, 1):
+                        if page_no not in scanned:
+                            dump.write_page(page_result)
+                    dump.close()
+                    meta = dict(metadata, originalname=metadata.get('originalname') or os.path.basename(key),
+                                sourcepages=",".join(map(str, scanned)), textlayer=f"{base}.textlayer.jsonl.gz")
+                    _s3().put_object(Bucket=_output_bucket(), Key=f"{base}.pdf", Body=_pdf_pages(data, scanned),
+                                     ContentType="application/pdf", Metadata=meta)
+                with metrics.stage("start_analysis"):
+                    results.append({"ok": True, "source": "text-layer+textract", "scannedPages": scanned,
+                                    "analysisJobId": _start_tables_analysis(_output_bucket(), f"{base}.pdf")})
+            else:
+                result, _ = _convert(pages, metadata, key, metrics)
+                result["source"] = "text-layer"
+                results.append(result)
+        finally:
+            metrics.emit()
+    return results[0] if len(results) == 1 else {"ok": True, "results": results}
+
+def replay_handler(event, _):
+    """
+    Re-runs the pipeline from a block dump written with SAVE_BLOCKS, without
+    calling Textract. Event: {"BlocksKey": "<key in OUTPUT_BUCKET>"} or
+    {"BlocksPath": "<local file>"}; "Metadata" overrides the stored source metadata.
+    """
+    if event.get("BlocksPath"):
+        fileobj = open(event["BlocksPath"], "rb")
+        location = event["BlocksPath"]
+    else:
+        key = event["BlocksKey"]
+        bucket = event.get("Bucket") or _output_bucket()
+        fileobj = _s3().get_object(Bucket=bucket, Key=key)["Body"]
+        location = f"s3://{bucket}/{key}"
+    metrics = _Metrics("replay_handler")
+    try:
+        header, pages = _read_block_dump(fileobj)
+        print(f"Replaying job {header.get('job_id')} from {location}")
+        metadata = dict(header.get("metadata") or {}, **event.get("Metadata", {}))
+        src_key = header.get("source", "").split("/", 3)[-1] or "incoming/unknown.pdf"
+        metrics.props.update(job_id=header.get("job_id"), source=location)
+        result, _ = _convert(pages, metadata, src_key, metrics)
+    finally:
+        fileobj.close()
+        metrics.emit()
+    result["replayedFrom"] = location
+    return result
@@ -0,0 +1,54 @@
+"""
+FITIDs: repeats within a statement stay distinct, a large synthetic ledger
+has no collisions, and FITID_HASH=md5 keeps the ids of previously imported
+accounts.
+"""
+import hashlib
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+import lambda_function as lf
+
+
+def _old_fitid(t):
+    # The baseline's _make_fitid, on the 32-character name the QBO builders passed it
+    name = (t.get("desc") or "")[:32]
+    return hashlib.md5(f"{t['date']:%Y%m%d}{t['amount']:.2f}{name}".encode("utf-8")).hexdigest()[:12]
+
+
+def _ledger(n, seed):
+    """n transactions over a year, drawn from few names and amounts so repeats are common."""
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    names = ["ATM FEE", "PURCHASE AUTHORIZED ON 02/15 THE HOME DEPOT", "ZELLE TO J SMITH", "DEPOSIT"]
+    return [{"date": start + timedelta(days=rng.randrange(366)), "desc": rng.choice(names),
+             "amount": rng.choice((-2.5, -3.0, -20.0, 100.0, round(rng.uniform(-500, 500), 2)))}
+            for _ in range(n)]
+
+
+def test_same_day_repeats_get_distinct_fitids():
+    fee = {"date": datetime(2024, 2, 15), "desc": "ATM FEE", "amount": -2.5}
+    ids = list(lf._iter_fitids([fee, dict(fee), dict(fee, date=datetime(2024, 2, 16))]))
+    assert len(set(ids)) == 3
+
+
+def test_no_collisions_in_a_large_ledger(monkeypatch):
+    txns = _ledger(50000, 19)
+    for algo in ("blake2s", "md5"):
+        monkeypatch.setattr(lf, "FITID_HASH", algo)
+        ids = list(lf._iter_fitids(txns))
+        assert len(set(ids)) == len(ids)
+
+
+def test_md5_keeps_the_old_ids_of_first_occurrences(monkeypatch):
+    monkeypatch.setattr(lf, "FITID_HASH", "md5")
+    txns = _ledger(2000, 20)
+    seen = set()
+    for t, fitid in zip(txns, lf._iter_fitids(txns)):
+        k = (t["date"], t["desc"], t["amount"])
+        if k not in seen:
+            seen.add(k)
+            assert fitid == _old_fitid(t)
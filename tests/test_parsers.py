@@ -0,0 +1,122 @@
+"""
+The single-regex _parse_date and _parse_amount against the strptime cascade
+and string-munging parsers they replaced (copied from the baseline), on
+fixed samples and seeded random cells.
+"""
+import os
+import random
+import re
+import sys
+from datetime import datetime
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+import lambda_function as lf
+
+_OLD_DATE_PATTERNS = [
+    "%Y-%m-%d", "%m/%d/%Y", "%m/%d/%y", "%d-%b-%Y", "%d-%b-%y", "%Y/%m/%d",
+    "%d/%m/%Y", "%d/%m/%y"
+]
+
+
+def _old_parse_date(s):
+    s = (s or "").strip()
+    if not s:
+        return None
+    for fmt in _OLD_DATE_PATTERNS:
+        try:
+            return datetime.strptime(s, fmt)
+        except ValueError:
+            pass
+    m = re.fullmatch(r"(\d{4})(\d{2})(\d{2})", s)
+    if m:
+        try:
+            return datetime(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+        except ValueError:
+            return None
+    return None
+
+
+def _old_parse_amount(s):
+    if s is None:
+        return None
+    txt = str(s).strip()
+    if not txt:
+        return None
+    if re.match(r'^\d{10,}$', txt):
+        return None
+    neg = False
+    if txt.startswith("(") and txt.endswith(")"):
+        neg = True
+        txt = txt[1:-1]
+    txt = txt.replace("$", "").replace(",", "").replace("USD", "").strip()
+    try:
+        val = float(txt)
+        if abs(val) > 1000000:
+            return None
+        return -val if neg else val
+    except ValueError:
+        return None
+
+
+DATES = ["2024-01-31", "1/31/2024", "01/31/24", "31-Jan-2024", "31-jan-24", "2024/01/31",
+         "31/01/2024", "13/12/24", "12/13/24", "2/29/2024", "2/30/2024", "20240131", "20241301",
+         "1/2", "", "  ", "Fecha", "Jan 31, 2024", "2024-1-5", "5-Feb-2024", "0/1/2024"]
+AMOUNTS = ["1,234.56", "$1,234.56", "(12.00)", "($5.25)", "-7.10", "USD 9.99", "0.00", "42",
+           "1000000", "1000001", "9999999999", "12345678901", ".50", "1.", "", "abc", "Saldo",
+           "1,2,3", "$", "()", "2/15"]
+# Forms the old parser rejected and the regex reads on purpose
+NEW_AMOUNTS = {"12.00-": -12.0, "45.10 CR": 45.1, "9.99 DR": -9.99, "- 5.00": -5.0, "-$ 5.00": -5.0}
+
+
+def _random_cells(alphabet, n, seed):
+    rng = random.Random(seed)
+    return ["".join(rng.choice(alphabet) for _ in range(rng.randint(1, 10))) for _ in range(n)]
+
+
+def _random_dates(n, seed):
+    """Date-shaped cells: three numbers (or a month name) of mixed widths and ranges, / or - between."""
+    rng = random.Random(seed)
+    parts = lambda: rng.choice((str(rng.randint(0, 13)), f"{rng.randint(0, 32):02d}",
+                                str(rng.randint(0, 32)), str(rng.randint(1990, 2030)), f"{rng.randint(0, 99):02d}"))
+    cells = []
+    for _ in range(n):
+        a, b, c = parts(), parts(), parts()
+        if rng.random() < 0.2:
+            b = rng.choice(("Jan", "feb", "DEC", "Sept", "mar"))
+        sep = rng.choice(("/", "-", "/", "-", ""))
+        cells.append(f"{a}{sep}{b}" + ("" if rng.random() < 0.1 else f"{sep}{c}"))
+    return cells
+
+
+def _random_amounts(n, seed):
+    """Amount cells as statements print them: grouping, cents, $/USD, minus or parentheses."""
+    rng = random.Random(seed)
+    cells = []
+    for _ in range(n):
+        v = rng.choice([0, rng.randint(0, 999), rng.randint(0, 10**6), rng.randint(10**6, 2 * 10**6),
+                        rng.randint(0, 10**12)])
+        s = f"{v:,}" if rng.random() < 0.5 else str(v)
+        if rng.random() < 0.6:
+            s += "." + str(rng.randint(0, 99)).zfill(rng.choice((1, 2)))
+        cur = rng.choice(("", "$", "USD ", "$ "))
+        sign = rng.choice(("", "-", "()"))
+        if sign == "()":
+            s = f"({cur}{s})"
+        elif sign == "-" and cur.endswith(" "):
+            s = f"{cur}-{s}"  # "-$ 5" is one of the NEW_AMOUNTS
+        else:
+            s = f"{sign}{cur}{s}" if rng.random() < 0.5 else f"{cur}{sign}{s}"
+        cells.append(rng.choice(("", " ")) + s + rng.choice(("", "", " ", " USD")))
+    return cells
+
+
+def test_parse_date_matches_strptime_cascade():
+    cells = (DATES + _random_dates(20000, 4) + _random_cells("0123456789/-", 20000, 5)
+             + _random_cells(["1", "2", "3", "0", "-", "/", "Jan", "Feb", "Dec", "20", "24"], 5000, 6))
+    assert [s for s in cells if lf._parse_date(s) != _old_parse_date(s)] == []
+
+
+def test_parse_amount_matches_old_parser():
+    cells = AMOUNTS + _random_amounts(20000, 7)
+    assert [s for s in cells if lf._parse_amount(s) != _old_parse_amount(s)] == []
+    assert {s: lf._parse_amount(s) for s in NEW_AMOUNTS} == NEW_AMOUNTS
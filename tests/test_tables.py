@@ -0,0 +1,32 @@
+"""
+Table classification and column layout on the Feb Textract export.
+"""
+import os
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+import lambda_batch as lb
+import lambda_function as lf
+
+FEB = os.path.join(ROOT, "Wells Fargo Doc converter", "Feb")
+
+
+def test_feb_keeps_only_transaction_tables():
+    headers = lf._header_matcher()
+    grids = lb.read_export_dir(FEB)
+    kept = [i for i, g in enumerate(grids) if lf._is_transaction_table(g, headers=headers)]
+    # table-3..6.csv; table-9.csv is the disclosure prose ("fecha", "descargar", "saldo")
+    assert kept == [2, 3, 4, 5]
+    assert lf._detect_header_indices(lb.read_table_csv(os.path.join(FEB, "table-9.csv"))[0], headers) is None
+
+
+def test_headerless_withdrawals_take_their_sign_from_the_balance():
+    # table-4.csv without its header: the deposits column is empty on this page
+    body = lb.read_table_csv(os.path.join(FEB, "table-4.csv"))[0][1:]
+    period = lf._StatementPeriod(lf._parse_date("2024-02-29"))
+    assert lf._profile_columns(body, period.end)["debit"] == 4
+    txns = lf._rows_to_transactions(body, lf._TableSchema(None, period))
+    assert len(txns) == 32 and all(t["amount"] < 0 for t in txns)
+    # Unsigned amounts and no balance to check them against: no guess
+    assert lf._profile_columns([r[:5] for r in body], period.end) is None
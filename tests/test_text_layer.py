@@ -0,0 +1,39 @@
+"""
+Text-layer extraction of the sample statements, checked against the Textract
+export of the same statement. Skipped when pypdf is not installed.
+"""
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("pypdf")
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+import lambda_batch as lb
+import lambda_function as lf
+
+SAMPLES = os.path.join(ROOT, "Wells Fargo Doc converter")
+
+
+def _key(t):
+    return t["date"], round(float(t["amount"]), 2), t["desc"]
+
+
+def test_feb_matches_textract_export():
+    pdf = lb.load_transactions(os.path.join(SAMPLES, "Feb.pdf"))["transactions"]
+    export = []
+    for n in (3, 4, 5, 6):
+        export += lb.load_transactions(os.path.join(SAMPLES, "Feb", f"table-{n}.csv"))["transactions"]
+    assert list(map(_key, pdf)) == list(map(_key, export))
+
+
+@pytest.mark.parametrize("name", ["Feb", "Mar", "Abril"])
+def test_statement_reconciles(name):
+    st = lb.load_transactions(os.path.join(SAMPLES, f"{name}.pdf"))
+    txns = st["transactions"]
+    assert txns and all(t["desc"] for t in txns)
+    recon = lf._reconcile(txns, st["balances"].get("opening"), st["balances"].get("closing"))
+    assert recon["opening"] is not None and recon["closing"] is not None
+    assert recon["reconciled"] and not recon["gaps"]